@@ -0,0 +1,300 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import pickle as pkl
+import numpy as np
+
+# Reproducible benchmarks of the hot paths on synthetic data. Images and captions are
+# drawn from fixed-seed distributions close to the CROHME sets (heights ~40-300 px,
+# widths ~100-1500 px, 3-80 tokens); the attention benchmark uses annotation maps of
+# the encoder output sizes of those images. Every timing is the median of --repeats
+# runs, in milliseconds; keys ending in _ms are compared against a baseline by
+# --compare and flagged when slower than --threshold.
+#
+#   python bench.py --out bench.json
+#   python bench.py --out new.json --compare bench.json
+
+VOCAB = 111
+CHANNELS = 684          # annotation channels of the DenseNet encoder in build_wap
+
+
+def synthetic_set(n, rng):
+    #### uint8 [1, H, W] images with a few random strokes and random token captions ####
+    features = {}
+    captions = {}
+    for i in range(n):
+        h = int(np.clip(rng.lognormal(np.log(110), 0.45), 40, 300))
+        w = int(np.clip(rng.lognormal(np.log(420), 0.55), 100, 1500))
+        image = np.zeros((1, h, w), dtype='uint8')
+        for _ in range(rng.randint(3, 20)):
+            y0, y1 = sorted(rng.randint(0, h, 2))
+            x0 = rng.randint(0, w - 8)
+            image[0, y0:y1 + 2, x0:x0 + rng.randint(2, 8)] = 255
+        uid = 'synthetic_%05d' % i
+        features[uid] = image
+        captions[uid] = list(rng.randint(1, VOCAB, int(np.clip(rng.lognormal(np.log(18), 0.6), 3, 80))))
+    return features, captions
+
+def write_set(features, captions, workdir):
+    #### the on-disk layout dataIterator reads: pickled features, caption file, dictionary ####
+    feature_file = os.path.join(workdir, 'features.pkl')
+    with open(feature_file, 'wb') as fp:
+        pkl.dump(features, fp)
+    label_file = os.path.join(workdir, 'captions.txt')
+    with open(label_file, 'w') as fp:
+        for uid, cap in captions.items():
+            fp.write(uid + '\t' + ' '.join('w%d' % c for c in cap) + '\n')
+    dictionary = dict(('w%d' % i, i) for i in range(VOCAB))
+    return feature_file, label_file, dictionary
+
+def quiet(fn):
+    #### dataIterator prints every dropped sample ####
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            return fn()
+        finally:
+            sys.stdout = stdout
+
+def timed(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return 1000. * float(np.median(times))
+
+
+class Context():
+    def __init__(self, workdir, samples, repeats, seed):
+        self.workdir = workdir
+        self.repeats = repeats
+        self.rng = np.random.RandomState(seed)
+        self.features, self.captions = synthetic_set(samples, self.rng)
+        self.feature_file, self.label_file, self.dictionary = write_set(self.features, self.captions, workdir)
+        self.seed = seed
+        self._graph = None
+
+    def graph(self):
+        #### one CPU training + sampling graph shared by the TF benchmarks ####
+        if self._graph is None:
+            import tensorflow as tf
+            from main import build_wap
+            tf.set_random_seed(self.seed)
+            with tf.device('/cpu:0'):
+                g = {}
+                g['x'] = tf.placeholder(tf.float32, shape=[None, None, None, 1])
+                g['x_mask'] = tf.placeholder(tf.float32, shape=[None, None, None])
+                g['y'] = tf.placeholder(tf.int32, shape=[None, None])
+                g['y_mask'] = tf.placeholder(tf.float32, shape=[None, None])
+                g['if_trainning'] = tf.placeholder(tf.bool, shape=())
+                wap, annotation, anno_mask = build_wap(g['x'], g['x_mask'], g['if_trainning'])
+                g['wap'] = wap
+                g['annotation'] = annotation
+                g['anno_mask'] = anno_mask
+                g['cost'] = wap.get_cost(annotation, g['y'], anno_mask, g['y_mask'])
+                with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
+                    g['trainer'] = tf.train.AdadeltaOptimizer(learning_rate=1.0).minimize(g['cost'])
+                channels = annotation.shape.as_list()[3]
+                g['anno'] = tf.placeholder(tf.float32, shape=[None, None, None, channels])
+                g['watch'] = tf.placeholder(tf.float32, shape=[None, None, None, wap.attender.dim_attend])
+                g['infer_y'] = tf.placeholder(tf.int64, shape=(None,))
+                g['h_pre'] = tf.placeholder(tf.float32, shape=[None, wap.hidden_dim])
+                g['alpha_past'] = tf.placeholder(tf.float32, shape=[None, None, None])
+                g['annotation_watch'] = wap.attender.get_watch_vector(annotation)
+                g['h_0'] = wap.get_h0(g['anno'], tf.ones(tf.shape(g['anno'])[:3]))
+                g['p'], g['w'], g['h'], g['alpha'] = wap.get_word(g['infer_y'], g['h_pre'], g['alpha_past'],
+                    g['anno'], None, g['watch'])
+            config = tf.ConfigProto(device_count={'GPU': 0})
+            g['sess'] = tf.Session(config=config)
+            g['sess'].run(tf.global_variables_initializer())
+            self._graph = g
+        return self._graph
+
+
+def bench_data_iterator(ctx):
+    from data import dataIterator
+    result = {}
+    for name, bucketing in [('sorted', False), ('bucketing', True)]:
+        load = lambda: quiet(lambda: dataIterator(ctx.feature_file, ctx.label_file, ctx.dictionary, batch_size=16,
+            batch_Imagesize=400000, maxlen=100, maxImagesize=400000, bucketing=bucketing))
+        result['load_%s_ms' % name] = timed(load, ctx.repeats)
+    return result
+
+def bench_prepare_data(ctx):
+    from data import dataIterator, prepare_data, BatchBuffers
+    batches, _ = quiet(lambda: dataIterator(ctx.feature_file, ctx.label_file, ctx.dictionary, batch_size=16,
+        batch_Imagesize=400000, maxlen=100, maxImagesize=400000))
+    buffers = BatchBuffers.from_batches(batches)
+    def run(buffers):
+        for batch_x, batch_y in batches:
+            prepare_data(batch_x, batch_y, buffers=buffers)
+    return {
+        'batches': len(batches),
+        'epoch_ms': timed(lambda: run(None), ctx.repeats),
+        'epoch_buffers_ms': timed(lambda: run(buffers), ctx.repeats),
+    }
+
+def bench_train_step(ctx):
+    from data import prepare_data
+    g = ctx.graph()
+    uids = sorted(ctx.features)
+    # a mid-size batch: 4 images around the median area
+    uids = sorted(uids, key=lambda u: ctx.features[u].size)[len(uids) // 2:len(uids) // 2 + 4]
+    xx, xx_m, yy, yy_m = prepare_data([ctx.features[u] for u in uids], [ctx.captions[u] for u in uids])
+    feed = {g['x']:xx, g['x_mask']:xx_m, g['y']:yy, g['y_mask']:yy_m, g['if_trainning']:True}
+    g['sess'].run([g['cost'], g['trainer']], feed_dict=feed)     # warm up
+    return {
+        'batch_pixels': int(xx.shape[0] * xx.shape[1] * xx.shape[2]),
+        'forward_ms': timed(lambda: g['sess'].run(g['cost'], feed_dict=feed), ctx.repeats),
+        'forward_backward_ms': timed(lambda: g['sess'].run([g['cost'], g['trainer']], feed_dict=feed), ctx.repeats),
+    }
+
+def bench_get_sample(ctx, beams=(1, 3, 5, 10), maxlen=30):
+    g = ctx.graph()
+    sess = g['sess']
+    uid = sorted(ctx.features, key=lambda u: ctx.features[u].size)[len(ctx.features) // 2]
+    xx_pad = (np.moveaxis(ctx.features[uid], 0, -1) / np.float32(255.))[None, :, :, :]
+    annot, annot_w = sess.run([g['annotation'], g['annotation_watch']], feed_dict={g['x']:xx_pad, g['if_trainning']:False})
+    h_state = sess.run(g['h_0'], feed_dict={g['anno']:annot})
+    result = {}
+    for k in beams:
+        steps = []
+        def decode():
+            sample, score = g['wap'].get_sample(g['anno'], g['infer_y'], g['h_pre'], g['alpha_past'], g['if_trainning'],
+                g['p'], g['w'], g['h'], g['alpha'], annot, h_state, k, maxlen, False, sess, training=False,
+                watch=g['watch'], watch0=annot_w)
+            steps.append(max(len(s) for s in sample))
+        decode()    # warm up
+        elapsed = timed(decode, ctx.repeats)
+        result['beam%d_image_ms' % k] = elapsed
+        result['beam%d_token_ms' % k] = elapsed / max(float(np.median(steps)), 1.)
+    return result
+
+def bench_cmp_result(ctx, n=200):
+    from wer import cmp_result, edit_distance_batch
+    rng = np.random.RandomState(ctx.seed)
+    labels = [list(rng.randint(1, VOCAB, rng.randint(150, 300))) for _ in range(n)]
+    recs = []
+    for lab in labels:
+        rec = list(lab)
+        for _ in range(len(rec) // 10):      # ~10% edits
+            pos = rng.randint(len(rec))
+            rec[pos] = rng.randint(1, VOCAB)
+        recs.append(rec[:len(rec) - rng.randint(0, 10)])
+    return {
+        'pairs': n,
+        'cmp_result_ms': timed(lambda: [cmp_result(l, r) for l, r in zip(labels, recs)], ctx.repeats),
+        'edit_distance_batch_ms': timed(lambda: edit_distance_batch(labels, recs), ctx.repeats),
+    }
+
+def bench_attention(ctx, sizes=((8, 26), (19, 94), (24, 160)), k=10, window=24):
+    #### one attention step for k beam rows, dense vs --attention_window, on random weights ####
+    #### agreement with the dense map is reported here; ExpRate needs trained weights: main.py --compare_decoders ####
+    import tensorflow as tf
+    from main import Attender
+    rng = np.random.RandomState(ctx.seed)
+    graph = tf.Graph()
+    with graph.as_default(), tf.device('/cpu:0'):
+        tf.set_random_seed(ctx.seed)
+        attender = Attender(CHANNELS, 256, 512, window=window)
+        anno = tf.placeholder(tf.float32, shape=[1, None, None, CHANNELS])
+        watch = tf.placeholder(tf.float32, shape=[1, None, None, attender.dim_attend])
+        h_pre = tf.placeholder(tf.float32, shape=[None, 256])
+        alpha_past = tf.placeholder(tf.float32, shape=[None, None, None])
+        dense = attender.get_context(anno, h_pre, alpha_past, None, watch, dense=True)[:2]
+        windowed = attender.get_context(anno, h_pre, alpha_past, None, watch)[:2]
+        sess = tf.Session(graph=graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+        sess.run(tf.global_variables_initializer())
+        watch_vector = attender.get_watch_vector(anno)
+    result = {'window': window, 'beam': k}
+    for hh, ww in sizes:
+        annot = rng.rand(1, hh, ww, CHANNELS).astype('float32')
+        # mid-expression: the left third of the map has been read
+        coverage = np.zeros((k, hh, ww), dtype='float32')
+        coverage[:, :, :ww // 3] = rng.rand(k, hh, ww // 3) * 2. / hh
+        feed = {anno:annot, watch:sess.run(watch_vector, feed_dict={anno:annot}),
+            h_pre:rng.randn(k, 256).astype('float32'), alpha_past:coverage}
+        name = '%dx%d' % (hh, ww)
+        result[name + '_dense_ms'] = timed(lambda: sess.run(dense, feed_dict=feed), ctx.repeats)
+        result[name + '_window_ms'] = timed(lambda: sess.run(windowed, feed_dict=feed), ctx.repeats)
+        (_, dense_alpha), (_, window_alpha) = sess.run([dense, windowed], feed_dict=feed)
+        result[name + '_peak_agreement'] = float(np.mean(dense_alpha.reshape(k, -1).argmax(1) == window_alpha.reshape(k, -1).argmax(1)))
+        result[name + '_alpha_l1'] = float(np.abs(dense_alpha - window_alpha).sum(axis=(1, 2)).mean())
+    return result
+
+BENCHMARKS = [
+    ('data_iterator', bench_data_iterator),
+    ('prepare_data', bench_prepare_data),
+    ('train_step', bench_train_step),
+    ('get_sample', bench_get_sample),
+    ('cmp_result', bench_cmp_result),
+    ('attention', bench_attention),
+]
+
+
+def compare(current, baseline, threshold):
+    #### timings more than `threshold` slower than the baseline ####
+    regressions = []
+    for name, metrics in current['results'].items():
+        for key, value in metrics.items():
+            if not key.endswith('_ms'):
+                continue
+            old = baseline['results'].get(name, {}).get(key)
+            if old is None or old <= 0:
+                continue
+            change = value / old - 1.
+            flag = 'REGRESSION' if change > threshold else ''
+            print('%-14s %-26s %10.2f -> %10.2f ms  %+6.1f%% %s' % (name, key, old, value, 100. * change, flag))
+            if flag:
+                regressions.append((name, key, change))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", default="bench.json")
+    parser.add_argument("--compare", default="")        # baseline JSON written by an earlier run
+    parser.add_argument("--threshold", type=float, default=0.10)   # relative slowdown flagged as a regression
+    parser.add_argument("--only", nargs="*", default=None, choices=[name for name, fn in BENCHMARKS])
+    parser.add_argument("--samples", type=int, default=400)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='wap-bench-')
+    try:
+        ctx = Context(workdir, args.samples, args.repeats, args.seed)
+        results = {}
+        for name, fn in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            print('running', name)
+            results[name] = fn(ctx)
+            print(json.dumps(results[name], sort_keys=True))
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {
+        'config': {'samples': args.samples, 'repeats': args.repeats, 'seed': args.seed},
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'results': results,
+    }
+    if 'tensorflow' in sys.modules:
+        report['environment']['tensorflow'] = sys.modules['tensorflow'].__version__
+    with open(args.out, 'w') as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(len(regressions), 'regressions over', '%.0f%%' % (100. * args.threshold))
+            sys.exit(1)
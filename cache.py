@@ -0,0 +1,93 @@
+import os
+import hashlib
+import collections
+import numpy as np
+
+# Encoder outputs keyed by (image content, weights version). Entries are tuples of
+# per-image arrays (annotation, watch vector, ...) without the batch axis. The most
+# recently used ones stay in memory; with a spill directory, entries evicted from
+# memory are written as .npy files and read back through memmaps on a later hit.
+
+def image_key(image):
+    image = np.ascontiguousarray(image)
+    digest = hashlib.sha1(str(image.shape).encode())
+    digest.update(image.view(np.uint8))
+    return digest.hexdigest()
+
+
+class AnnotationCache():
+    def __init__(self, max_bytes, spill_dir=None, max_spill_bytes=0):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes      # 0: no limit on the spill directory
+        self.memory = collections.OrderedDict()     # (key, version) -> arrays, least recently used first
+        self.spilled = collections.OrderedDict()    # (key, version) -> (file names of the arrays, bytes)
+        self.bytes = 0
+        self.spill_bytes = 0
+        self.hits = 0
+        self.spill_hits = 0
+        self.misses = 0
+        if spill_dir and not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+
+    def get(self, image, version):
+        entry = (image_key(image), version)
+        if entry in self.memory:
+            self.memory.move_to_end(entry)
+            self.hits += 1
+            return self.memory[entry]
+        if entry in self.spilled:
+            files, nbytes = self.spilled.pop(entry)
+            arrays = tuple(np.array(np.load(f, mmap_mode='r')) for f in files)
+            self.drop_files(files, nbytes)
+            self.spill_hits += 1
+            self.insert(entry, arrays)
+            return arrays
+        self.misses += 1
+        return None
+
+    def put(self, image, version, arrays):
+        entry = (image_key(image), version)
+        if entry in self.memory:
+            self.memory.move_to_end(entry)
+            return
+        self.insert(entry, tuple(np.asarray(a) for a in arrays))
+
+    def insert(self, entry, arrays):
+        self.memory[entry] = arrays
+        self.bytes += sum(a.nbytes for a in arrays)
+        while self.bytes > self.max_bytes and self.memory:
+            old, old_arrays = self.memory.popitem(last=False)
+            self.bytes -= sum(a.nbytes for a in old_arrays)
+            if self.spill_dir:
+                self.spill(old, old_arrays)
+
+    def spill(self, entry, arrays):
+        files = []
+        for idx, a in enumerate(arrays):
+            f = os.path.join(self.spill_dir, '%s-%s-%d.npy' % (entry[0], entry[1], idx))
+            np.save(f, a)
+            files.append(f)
+        nbytes = sum(a.nbytes for a in arrays)
+        self.spilled[entry] = (files, nbytes)
+        self.spill_bytes += nbytes
+        while self.max_spill_bytes and self.spill_bytes > self.max_spill_bytes and self.spilled:
+            self.drop_files(*self.spilled.popitem(last=False)[1])
+
+    def drop_files(self, files, nbytes):
+        for f in files:
+            os.remove(f)
+        self.spill_bytes -= nbytes
+
+    def retain(self, version):
+        #### forget every entry computed with other weights ####
+        for entry in [e for e in self.memory if e[1] != version]:
+            self.bytes -= sum(a.nbytes for a in self.memory.pop(entry))
+        for entry in [e for e in self.spilled if e[1] != version]:
+            self.drop_files(*self.spilled.pop(entry))
+
+    def stats(self):
+        lookups = max(self.hits + self.spill_hits + self.misses, 1)
+        return 'annotation cache: %d in memory (%.1f MB), %d spilled (%.1f MB), hit rate %.1f%% (%.1f%% from disk)' % (
+            len(self.memory), self.bytes / 2.**20, len(self.spilled), self.spill_bytes / 2.**20,
+            100. * (self.hits + self.spill_hits) / lookups, 100. * self.spill_hits / lookups)
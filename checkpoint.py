@@ -0,0 +1,77 @@
+import os
+import pickle
+import threading
+import queue
+import tensorflow as tf
+
+# Training checkpoints: every global variable (weights, batch norm statistics and
+# optimizer slots) plus a picklable dict of loop state. The session only stalls for
+# the snapshot fetch; pickling and disk I/O happen on a background thread.
+
+def snapshot(sess, variables=None):
+    if variables is None:
+        variables = tf.global_variables()
+    values = sess.run(variables)
+    return dict((v.name, value) for v, value in zip(variables, values))
+
+def restore(sess, weights):
+    #### load every global variable found in `weights`, returns the names that were not ####
+    missing = []
+    for v in tf.global_variables():
+        if v.name in weights:
+            v.load(weights[v.name], sess)
+        else:
+            missing.append(v.name)
+    return missing
+
+def write_checkpoint(path, weights, state):
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fp:
+        pickle.dump({'weights': weights, 'state': state}, fp, protocol=4)
+    os.replace(tmp, path)       # a crash mid-write never clobbers the previous checkpoint
+
+def read_checkpoint(path):
+    with open(path, 'rb') as fp:
+        ckpt = pickle.load(fp)
+    return ckpt['weights'], ckpt['state']
+
+
+class CheckpointWriter():
+    # A failed write is kept and raised from the next save() / close(); the worker
+    # keeps draining the queue afterwards so that neither of them can block.
+    def __init__(self, depth=2):
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                write_checkpoint(*item)
+            except Exception as e:
+                self.error = e
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, path, weights, state):
+        self.check()
+        self.queue.put((path, weights, state))
+
+    def close(self):
+        #### wait for pending writes ####
+        self.queue.put(None)
+        self.worker.join()
+        self.check()
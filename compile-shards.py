@@ -0,0 +1,20 @@
+import argparse
+from data import load_dict, compile_shards
+
+# Convert offline-*.pkl + caption file into memory-mapped shards that
+# dataIterator can read in place (pass the output directory as feature_file).
+# --crop / --max_pixels store the preprocessed images, so it is done only once.
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("feature_file")
+    parser.add_argument("label_file")
+    parser.add_argument("dictionary")
+    parser.add_argument("shard_dir")
+    parser.add_argument("--shard_mb", type=int, default=256)
+    parser.add_argument("--crop", action="store_true")  # tight crop to the ink bounding box
+    parser.add_argument("--max_pixels", type=int, default=0)  # downscale larger images, 0 keeps full resolution
+    args = parser.parse_args()
+    worddicts = load_dict(args.dictionary)
+    compile_shards(args.feature_file, args.label_file, worddicts, args.shard_dir,
+        shard_bytes=args.shard_mb * 1024 * 1024, max_pixels=args.max_pixels, crop=args.crop)
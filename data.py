@@ -2,14 +2,163 @@ import numpy
 import sys
 import pickle as pkl
 import gzip
+import os
+import json
+import time
+import threading
+import queue
 
 
-def dataIterator(feature_file, label_file, dictionary, batch_size, batch_Imagesize, maxlen, maxImagesize):
+# one row per sample in a compiled dataset, images live in images-XXXXX.bin
+SHARD_INDEX_DTYPE=numpy.dtype([('shard','int32'),('offset','int64'),('channels','int32'),
+    ('height','int32'),('width','int32'),('label_offset','int64'),('label_length','int32')])
+
+
+def load_shards(shard_dir):
+    #### index of the compiled dataset: one row per sample, images stay on disk ####
+    index=numpy.load(os.path.join(shard_dir,'index.npy'))
+    fp=open(os.path.join(shard_dir,'uids.txt'),'r')
+    uids=[l.strip() for l in fp.readlines()]
+    fp.close()
+
+    # read-only memmaps are shared through the page cache by every process
+    blobs={}
+    for shard in numpy.unique(index['shard']):
+        blobs[shard]=numpy.memmap(os.path.join(shard_dir,'images-%05d.bin'%shard),dtype='uint8',mode='r')
+    label_blob=numpy.load(os.path.join(shard_dir,'labels.npy'),mmap_mode='r')
+
+    features={}
+    targets={}
+    for uid,row in zip(uids,index):
+        c,h,w=int(row['channels']),int(row['height']),int(row['width'])
+        start=int(row['offset'])
+        features[uid]=blobs[row['shard']][start:start+c*h*w].reshape(c,h,w)
+        start=int(row['label_offset'])
+        targets[uid]=label_blob[start:start+int(row['label_length'])].tolist()
+
+    return features,targets
+
+
+def area_weights(size, new_size):
+    #### [new_size, size] box filter: every output pixel averages the input span it covers ####
+    edges=numpy.arange(new_size+1)*float(size)/new_size
+    lo=numpy.maximum(edges[:-1,None],numpy.arange(size)[None,:])
+    hi=numpy.minimum(edges[1:,None],numpy.arange(size)[None,:]+1)
+    weights=numpy.maximum(hi-lo,0.)
+    return weights/weights.sum(axis=1,keepdims=True)
+
+def crop_ink(fea, margin=2, threshold=0):
+    #### tight crop to the bounding box of the ink (pixels > threshold) plus a margin ####
+    ink=(fea>threshold).any(axis=0)
+    rows=numpy.nonzero(ink.any(axis=1))[0]
+    cols=numpy.nonzero(ink.any(axis=0))[0]
+    if len(rows)==0: # blank image
+        return fea
+    top,bottom=max(rows[0]-margin,0),min(rows[-1]+margin+1,fea.shape[1])
+    left,right=max(cols[0]-margin,0),min(cols[-1]+margin+1,fea.shape[2])
+    return fea[:,top:bottom,left:right]
+
+def downscale(fea, max_pixels):
+    #### area downscale to at most max_pixels, same scale on both axes keeps the aspect ratio ####
+    h,w=fea.shape[1],fea.shape[2]
+    if h*w<=max_pixels:
+        return fea
+    scale=numpy.sqrt(float(max_pixels)/(h*w))
+    new_h,new_w=max(int(h*scale),1),max(int(w*scale),1)
+    # rows then columns as two matmuls; one einsum over all four indices is O(h*w*new_h*new_w)
+    rows=area_weights(h,new_h).astype('float32')
+    cols=area_weights(w,new_w).astype('float32')
+    fea=numpy.matmul(numpy.matmul(rows,fea.astype('float32')),cols.T)
+    return numpy.clip(numpy.round(fea),0,255).astype('uint8')
+
+def crop_and_scale(fea, max_pixels=0, crop=True):
+    if crop:
+        fea=crop_ink(fea)
+    if max_pixels>0:
+        fea=downscale(fea,max_pixels)
+    return numpy.ascontiguousarray(fea,dtype='uint8')
+
+def preprocess_features(features, max_pixels=0, crop=True):
+    #### crop_and_scale every image; returns the new feature dict and pixel statistics ####
+    stats={'samples':len(features),'cropped':0,'scaled':0,'pixels_before':0,'pixels_after':0,
+        'max_pixels':max_pixels,'crop':crop}
+    processed={}
+    for uid,fea in features.items():
+        stats['pixels_before']+=fea.shape[1]*fea.shape[2]
+        if crop:
+            new=crop_ink(fea)
+            stats['cropped']+=int(new.shape!=fea.shape)
+            fea=new
+        if max_pixels>0:
+            new=downscale(fea,max_pixels)
+            stats['scaled']+=int(new.shape!=fea.shape)
+            fea=new
+        processed[uid]=numpy.ascontiguousarray(fea,dtype='uint8')
+        stats['pixels_after']+=fea.shape[1]*fea.shape[2]
+    return processed,stats
+
+def preprocess_report(stats):
+    saved=1.-float(stats['pixels_after'])/max(stats['pixels_before'],1)
+    return 'preprocess: %d samples, %d cropped, %d downscaled, %d -> %d pixels (%.1f%% saved)'%(
+        stats['samples'],stats['cropped'],stats['scaled'],stats['pixels_before'],stats['pixels_after'],100.*saved)
+
+
+def compile_shards(feature_file, label_file, dictionary, shard_dir, shard_bytes=256*1024*1024, max_pixels=0, crop=False):
 
     fp=open(feature_file,'rb')
     features=pkl.load(fp)
     fp.close()
 
+    targets=load_targets(label_file,dictionary)
+
+    stats=None
+    if crop or max_pixels>0:
+        # compiled once, so every epoch and process reads the preprocessed images
+        features,stats=preprocess_features(features,max_pixels,crop)
+        print(preprocess_report(stats))
+
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+
+    uids=sorted(features.keys())
+    index=numpy.zeros(len(uids),dtype=SHARD_INDEX_DTYPE)
+    labels=[]
+    label_offset=0
+    shard=0
+    offset=0
+    fp=open(os.path.join(shard_dir,'images-%05d.bin'%shard),'wb')
+    for i,uid in enumerate(uids):
+        fea=numpy.ascontiguousarray(features[uid],dtype='uint8')
+        if offset>0 and offset+fea.nbytes>shard_bytes: # a shard is full
+            fp.close()
+            shard+=1
+            offset=0
+            fp=open(os.path.join(shard_dir,'images-%05d.bin'%shard),'wb')
+        fp.write(fea.tobytes())
+        lab=targets[uid]
+        index[i]=(shard,offset,fea.shape[0],fea.shape[1],fea.shape[2],label_offset,len(lab))
+        offset+=fea.nbytes
+        label_offset+=len(lab)
+        labels.extend(lab)
+    fp.close()
+
+    numpy.save(os.path.join(shard_dir,'index.npy'),index)
+    numpy.save(os.path.join(shard_dir,'labels.npy'),numpy.array(labels,dtype='int32'))
+    fp=open(os.path.join(shard_dir,'uids.txt'),'w')
+    for uid in uids:
+        fp.write(uid+'\n')
+    fp.close()
+    if stats is not None:
+        fp=open(os.path.join(shard_dir,'preprocess.json'),'w')
+        json.dump(stats,fp)
+        fp.close()
+
+    print('total ',len(uids),'samples compiled into',shard+1,'shards')
+    return len(uids)
+
+
+def load_targets(label_file, dictionary):
+
     fp2=open(label_file,'r')
     labels=fp2.readlines()
     fp2.close()
@@ -28,6 +177,33 @@ def dataIterator(feature_file, label_file, dictionary, batch_size, batch_Imagesi
                 sys.exit()
         targets[uid]=w_list
 
+    return targets
+
+
+def dataIterator(feature_file, label_file, dictionary, batch_size, batch_Imagesize, maxlen, maxImagesize, bucketing=False,
+                 crop=False, max_pixels=0):
+
+    if os.path.isdir(feature_file):
+        # compiled shards (see compile-shards.py) carry their own labels
+        features,targets=load_shards(feature_file)
+        stats_file=os.path.join(feature_file,'preprocess.json')
+        if os.path.exists(stats_file): # preprocessed when compiled
+            fp=open(stats_file,'r')
+            print(preprocess_report(json.load(fp)))
+            fp.close()
+    else:
+        fp=open(feature_file,'rb')
+        features=pkl.load(fp)
+        fp.close()
+
+        targets=load_targets(label_file,dictionary)
+
+        # shards get --crop / --max_pixels from compile-shards.py and stay memory-mapped here
+        if crop or max_pixels>0:
+            # images above max_pixels are downscaled, so with max_pixels <= maxImagesize none is dropped for its size
+            features,stats=preprocess_features(features,max_pixels,crop)
+            print(preprocess_report(stats))
+
 
 
     imageSize={}
@@ -42,6 +218,8 @@ def dataIterator(feature_file, label_file, dictionary, batch_size, batch_Imagesi
     feature_total=[]
     label_total=[]
     uidList=[]
+    kept_features=[]
+    kept_labels=[]
 
     batch_image_size=0
     biggest_image_size=0
@@ -58,6 +236,8 @@ def dataIterator(feature_file, label_file, dictionary, batch_size, batch_Imagesi
             print('image', uid, 'size bigger than', maxImagesize, 'ignore')
         else:
             uidList.append(uid)
+            kept_features.append(fea)
+            kept_labels.append(lab)
             if batch_image_size>batch_Imagesize or i==batch_size: # a batch is full
                 feature_total.append(feature_batch)
                 label_total.append(label_batch)
@@ -79,10 +259,92 @@ def dataIterator(feature_file, label_file, dictionary, batch_size, batch_Imagesi
     feature_total.append(feature_batch)
     label_total.append(label_batch)
 
+    if bucketing:
+        sampler=BucketSampler(kept_features,kept_labels,batch_size,batch_Imagesize)
+        print('total ',len(sampler), 'batch data loaded (bucketed)')
+        return sampler,uidList
+
     print('total ',len(feature_total), 'batch data loaded')
 
     return list(zip(feature_total,label_total)),uidList
 
+
+def padding_ratio(batches):
+    #### share of fed pixels that are padding: 1 - sum(H*W) / sum(n*max(H)*max(W)) ####
+    padded=0
+    real=0
+    for images_x, _ in batches:
+        heights=[s.shape[1] for s in images_x]
+        widths=[s.shape[2] for s in images_x]
+        padded+=len(images_x)*max(heights)*max(widths)
+        real+=sum(h*w for h,w in zip(heights,widths))
+    return 1.-float(real)/max(padded,1)
+
+
+class BucketSampler():
+    # Groups samples by (height, width) bucket and packs each batch against the real
+    # padded size n * max(H) * max(W). Buckets are rebuilt with a fresh in-bucket
+    # shuffle on every pass; padding_ratio holds the padded share of the current pass.
+    def __init__(self, features, labels, batch_size, batch_Imagesize, bucket_step=32, rng=None):
+        self.features = features
+        self.labels = labels
+        self.batch_size = batch_size
+        self.batch_Imagesize = batch_Imagesize
+        self.bucket_step = bucket_step
+        self.heights = numpy.array([s.shape[1] for s in features], dtype='int64')
+        self.widths = numpy.array([s.shape[2] for s in features], dtype='int64')
+        self.rng = rng if rng is not None else numpy.random.RandomState()
+        self.padding_ratio = 0.
+        self.batches = self.build()
+        self.fresh = True
+
+    def build(self):
+        #### random order inside each bucket, buckets ordered by (H, W) so neighbours have similar shapes ####
+        self.build_state = self.rng.get_state()     # enough to rebuild this exact pass, see restore()
+        order = self.rng.permutation(len(self.features))
+        order = order[numpy.lexsort((self.widths[order] // self.bucket_step, self.heights[order] // self.bucket_step))]
+
+        batches = []
+        batch = []
+        max_h = 0
+        max_w = 0
+        padded = 0
+        for idx in order:
+            h = max(max_h, self.heights[idx])
+            w = max(max_w, self.widths[idx])
+            if batch and (len(batch) == self.batch_size or (len(batch) + 1) * h * w > self.batch_Imagesize): # a batch is full
+                batches.append(batch)
+                padded += len(batch) * max_h * max_w
+                batch = []
+                h = self.heights[idx]
+                w = self.widths[idx]
+            batch.append(idx)
+            max_h = h
+            max_w = w
+        if batch:
+            batches.append(batch)
+            padded += len(batch) * max_h * max_w
+
+        real = (self.heights * self.widths).sum()
+        self.padding_ratio = 1. - float(real) / max(padded, 1)
+        self.rng.shuffle(batches)
+        return [([self.features[i] for i in b], [self.labels[i] for i in b]) for b in batches]
+
+    def restore(self, build_state):
+        #### make the next pass repeat the one that was built from build_state ####
+        self.rng.set_state(build_state)
+        self.batches = self.build()
+        self.fresh = True
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        if not self.fresh:
+            self.batches = self.build()
+        self.fresh = False
+        return iter(self.batches)
+
 def load_dict(dictFile):
     fp=open(dictFile)
     stuff=fp.readlines()
@@ -96,8 +358,147 @@ def load_dict(dictFile):
     return lexicon
 
 
+class BatchBuffers():
+    # Pool of preallocated float32 batch buffers. prepare() writes normalized pixels
+    # straight into the next slot and returns contiguous views of it, so a returned
+    # batch stays valid until pool_size further calls to prepare().
+    def __init__(self, pixels, samples, steps, pool_size=2):
+        self.pool_size = pool_size
+        self.slot = 0
+        self.x = [None] * pool_size
+        self.x_mask = [None] * pool_size
+        self.y = [None] * pool_size
+        self.y_mask = [None] * pool_size
+        self.pixels = 0
+        self.cells = 0
+        self.reserve(pixels, samples * steps)
+
+    @classmethod
+    def from_batches(cls, batches, pool_size=2):
+        #### size the pool to the largest bucket so training never reallocates ####
+        pixels = 0
+        cells = 0
+        for images_x, seqs_y in batches:
+            n = len(images_x)
+            pixels = max(pixels, n * max(s.shape[1] for s in images_x) * max(s.shape[2] for s in images_x))
+            cells = max(cells, n * (max(len(s) for s in seqs_y) + 1))
+        return cls(pixels, 1, cells, pool_size=pool_size)
+
+    def reserve(self, pixels, cells):
+        if pixels > self.pixels:
+            self.pixels = pixels
+            self.x = [numpy.empty((pixels,), dtype='float32') for _ in range(self.pool_size)]
+            self.x_mask = [numpy.empty((pixels,), dtype='float32') for _ in range(self.pool_size)]
+        if cells > self.cells:
+            self.cells = cells
+            self.y = [numpy.empty((cells,), dtype='int64') for _ in range(self.pool_size)]
+            self.y_mask = [numpy.empty((cells,), dtype='float32') for _ in range(self.pool_size)]
+
+    def prepare(self, images_x, seqs_y):
+        heights_x = numpy.array([s.shape[1] for s in images_x])
+        widths_x = numpy.array([s.shape[2] for s in images_x])
+        lengths_y = numpy.array([len(s) for s in seqs_y])
+
+        n_samples = len(heights_x)
+        max_height_x = heights_x.max()
+        max_width_x = widths_x.max()
+        maxlen_y = lengths_y.max() + 1
+        self.reserve(n_samples * max_height_x * max_width_x, n_samples * maxlen_y)
+
+        slot = self.slot
+        self.slot = (self.slot + 1) % self.pool_size
+
+        x = self.x[slot][:n_samples * max_height_x * max_width_x].reshape(n_samples, max_height_x, max_width_x, 1)
+        x_mask = self.x_mask[slot][:n_samples * max_height_x * max_width_x].reshape(n_samples, max_height_x, max_width_x)
+        y = self.y[slot][:n_samples * maxlen_y].reshape(maxlen_y, n_samples)
+        y_mask = self.y_mask[slot][:n_samples * maxlen_y].reshape(maxlen_y, n_samples)
+
+        #### masks from broadcast comparisons, no per-sample loop ####
+        rows = numpy.arange(max_height_x)[None, :] < heights_x[:, None]
+        cols = numpy.arange(max_width_x)[None, :] < widths_x[:, None]
+        numpy.multiply(rows[:, :, None], cols[:, None, :], out=x_mask, casting='unsafe')
+        numpy.less_equal(numpy.arange(maxlen_y)[:, None], lengths_y[None, :], out=y_mask, casting='unsafe')
+
+        y.fill(0) # the <eol> must be 0 in the dict !!!
+        for idx, [s_x, s_y] in enumerate(zip(images_x, seqs_y)):
+            h, w = heights_x[idx], widths_x[idx]
+            # uint8 * float32 scalar stays float32 and lands directly in the buffer
+            numpy.multiply(s_x[0], numpy.float32(1. / 255.), out=x[idx, :h, :w, 0])
+            x[idx, :h, w:, 0] = 0.
+            x[idx, h:, :, 0] = 0.
+            y[:lengths_y[idx], idx] = s_y
+
+        return x, x_mask, y, y_mask
+
+
+class BatchPrefetcher():
+    # Runs prepare_data in a background thread and keeps up to `depth` ready
+    # batches in a bounded queue. `starved` counts gets that found the queue
+    # empty, i.e. steps where the graph had to wait for input.
+    def __init__(self, buffers=None, depth=2):
+        if buffers is not None:
+            assert buffers.pool_size >= depth + 2, 'buffer pool must outlive the prefetch queue'
+        self.buffers = buffers
+        self.depth = depth
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.batches = 0
+        self.starved = 0
+        self.wait_time = 0.
+
+    def _put(self, out, stop, item):
+        #### False once the consumer has gone away ####
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, batches, out, stop):
+        try:
+            for batch_x, batch_y in batches:
+                if not self._put(out, stop, prepare_data(batch_x, batch_y, buffers=self.buffers)):
+                    return
+            self._put(out, stop, None)
+        except Exception as e:
+            self._put(out, stop, e)
+
+    def __call__(self, batches):
+        out = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._produce, args=(batches, out, stop))
+        worker.daemon = True
+        worker.start()
+        try:
+            while True:
+                empty = out.empty()
+                start = time.time()
+                item = out.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                self.wait_time += time.time() - start
+                self.batches += 1
+                self.starved += empty
+                yield item
+        finally:
+            stop.set()
+            worker.join()
+
+    def report(self):
+        return 'Prefetch batches %d starved %d (%.1f%%) wait %.2fs' % (self.batches, self.starved,
+            100. * self.starved / max(self.batches, 1), self.wait_time)
+
+
 def prepare_data(images_x, seqs_y, n_words_src=30000,
-                 n_words=30000):
+                 n_words=30000, buffers=None):
+
+    if buffers is not None:
+        return buffers.prepare(images_x, seqs_y)
 
     heights_x = [s.shape[1] for s in images_x]
     widths_x = [s.shape[2] for s in images_x]
@@ -108,12 +509,12 @@ def prepare_data(images_x, seqs_y, n_words_src=30000,
     max_width_x = numpy.max(widths_x)
     maxlen_y = numpy.max(lengths_y) + 1
 
-    x = numpy.zeros((n_samples, max_height_x, max_width_x, 1)).astype('float32')
-    y = numpy.zeros((maxlen_y, n_samples)).astype('int64') # the <eol> must be 0 in the dict !!!
-    x_mask = numpy.zeros((n_samples, max_height_x, max_width_x)).astype('float32')
-    y_mask = numpy.zeros((maxlen_y, n_samples)).astype('float32')
+    x = numpy.zeros((n_samples, max_height_x, max_width_x, 1), dtype='float32')
+    y = numpy.zeros((maxlen_y, n_samples), dtype='int64') # the <eol> must be 0 in the dict !!!
+    x_mask = numpy.zeros((n_samples, max_height_x, max_width_x), dtype='float32')
+    y_mask = numpy.zeros((maxlen_y, n_samples), dtype='float32')
     for idx, [s_x, s_y] in enumerate(zip(images_x, seqs_y)):
-        x[idx, :heights_x[idx], :widths_x[idx], :] = (numpy.moveaxis(s_x, 0, -1) / 255.) # [B, C, H, W] -> [B, H, W, C]
+        x[idx, :heights_x[idx], :widths_x[idx], 0] = s_x[0] * numpy.float32(1. / 255.)
         x_mask[idx, :heights_x[idx], :widths_x[idx]] = 1.
         y[:lengths_y[idx], idx] = s_y
         y_mask[:lengths_y[idx]+1, idx] = 1.
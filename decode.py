@@ -0,0 +1,96 @@
+import numpy as np
+import tensorflow as tf
+import multiprocessing
+from data import prepare_data
+
+# Validation decoding in a pool of CPU worker processes. Every worker builds the
+# inference graph once, restores the weight snapshot written by save_weights
+# whenever its version changes and decodes contiguous shards of the image list.
+
+_worker = {}
+
+def model_variables():
+    #### what a decoder needs: trainable weights plus the batch norm moving statistics ####
+    return tf.trainable_variables() + [v for v in tf.global_variables() if 'moving_' in v.name]
+
+def save_weights(sess, path):
+    variables = model_variables()
+    values = sess.run(variables)
+    np.savez(path, **dict((v.name, value) for v, value in zip(variables, values)))
+
+def load_weights(sess, path):
+    weights = np.load(path)
+    # a worker graph that names its variables differently from the trainer's would keep decoding with random weights
+    missing = [v.name for v in model_variables() if v.name not in weights]
+    if missing:
+        raise ValueError('%s lacks %s' % (path, ', '.join(missing)))
+    for v in model_variables():
+        v.load(weights[v.name], sess)
+
+def _init_worker(mode, k, maxlen, threads, memory_efficient, attention_window, attention_fallback):
+    from main import build_wap     # main imports this module, so resolve it lazily
+    with tf.device('/cpu:0'):
+        x = tf.placeholder(tf.float32, shape=[None, None, None, 1])
+        x_mask = tf.placeholder(tf.float32, shape=[None, None, None])
+        if_trainning = tf.placeholder(tf.bool, shape=())
+        # built like the trainer's graph, so variable names and the attention window match
+        wap, annotation, anno_mask = build_wap(x, x_mask, if_trainning, memory_efficient=memory_efficient,
+            attention_window=attention_window, attention_fallback=attention_fallback)
+        if mode == 'greedy':
+            _worker['sample'] = wap.get_sample_greedy(annotation, anno_mask, maxlen)
+        else:
+            _worker['resident'] = wap.build_resident_decoder(annotation)
+    config = tf.ConfigProto(device_count={'GPU': 0}, intra_op_parallelism_threads=threads,
+        inter_op_parallelism_threads=1)
+    sess = tf.Session(config=config)
+    sess.run(tf.global_variables_initializer())
+    _worker.update(sess=sess, wap=wap, x=x, x_mask=x_mask, if_trainning=if_trainning,
+        mode=mode, k=k, maxlen=maxlen, version=None)
+
+def _decode_shard(task):
+    version, weights_file, items = task
+    w = _worker
+    if w['version'] != version:
+        load_weights(w['sess'], weights_file)
+        w['version'] = version
+
+    if w['mode'] == 'greedy':
+        xx, xx_m, _, _ = prepare_data([fea for idx, fea in items], [[]] * len(items))
+        decoded = w['sess'].run(w['sample'], feed_dict={w['x']:xx, w['x_mask']:xx_m, w['if_trainning']:False})
+    else:
+        load, beam_parent, beam_y, p = w['resident']
+        decoded = []
+        for idx, fea in items:
+            xx_pad = (np.moveaxis(fea, 0, -1) / np.float32(255.))[None, :, :, :]
+            sample, score = w['wap'].get_sample_resident(load, beam_parent, beam_y, p, w['if_trainning'],
+                {w['x']:xx_pad, w['if_trainning']:False}, w['k'], w['maxlen'], w['sess'], training=False)
+            score = np.array(score) / np.array([len(s) for s in sample])
+            decoded.append(sample[score.argmin()])
+
+    return [(idx, [int(vv) for vv in ss]) for (idx, fea), ss in zip(items, decoded)]
+
+
+class DecodePool():
+    def __init__(self, workers, mode='beam', k=10, maxlen=100, threads=1, shard_size=8, memory_efficient=False,
+                 attention_window=0, attention_fallback=0.2):
+        # spawn, not fork: the parent already holds a TF runtime
+        ctx = multiprocessing.get_context('spawn')
+        self.pool = ctx.Pool(workers, initializer=_init_worker, initargs=(mode, k, maxlen, threads, memory_efficient,
+            attention_window, attention_fallback))
+        self.shard_size = shard_size
+
+    def decode(self, weights_file, version, images):
+        #### decoded token lists in the order of `images` ####
+        tasks = []
+        for start in range(0, len(images), self.shard_size):
+            items = [(idx, images[idx]) for idx in range(start, min(start + self.shard_size, len(images)))]
+            tasks.append((version, weights_file, items))
+        decoded = [None] * len(images)
+        for shard in self.pool.imap_unordered(_decode_shard, tasks):
+            for idx, ss in shard:
+                decoded[idx] = ss
+        return decoded
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
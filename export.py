@@ -0,0 +1,122 @@
+import os
+import json
+import argparse
+import numpy as np
+import tensorflow as tf
+from checkpoint import read_checkpoint
+from main import build_wap
+
+# Export frozen inference graphs from a training checkpoint:
+#   encoder.pb      image -> annotation, annotation mask, U_a projection, h_0
+#   decoder_step.pb one decoding step (word, state, coverage) -> probs, state, coverage
+# Batch norm is folded into the preceding conv (W' = W * g / sqrt(v + eps),
+# b' = beta - m * g / sqrt(v + eps)), dropout is built with training=False so no
+# dropout ops exist, and all variables become constants that are then folded.
+
+BN_EPSILON = 0.0001
+
+def layer_name(base, idx):
+    return base if idx == 0 else '%s_%d' % (base, idx)
+
+def fold_batch_norm(weights):
+    #### every conv2d_i in Watcher_train is followed by batch_normalization_i ####
+    folded = dict((name, value) for name, value in weights.items()
+        if not name.startswith('batch_normalization') and not name.startswith('conv2d'))
+    idx = 0
+    while layer_name('conv2d', idx) + '/kernel:0' in weights:
+        conv = layer_name('conv2d', idx)
+        bn = layer_name('batch_normalization', idx)
+        kernel = weights[conv + '/kernel:0']
+        scale = weights[bn + '/gamma:0'] / np.sqrt(weights[bn + '/moving_variance:0'] + BN_EPSILON)
+        folded[conv + '/kernel:0'] = (kernel * scale).astype('float32')  # scale broadcasts over output channels
+        folded[conv + '/bias:0'] = (weights[bn + '/beta:0'] - weights[bn + '/moving_mean:0'] * scale).astype('float32')
+        idx += 1
+    print('folded', idx, 'batch norms into their convolutions')
+    return folded
+
+def freeze(sess, outputs):
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), outputs)
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=outputs)
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+        inputs = [n.name for n in graph_def.node if n.op == 'Placeholder']
+        graph_def = TransformGraph(graph_def, inputs, outputs,
+            ['fold_constants(ignore_errors=true)', 'strip_unused_nodes', 'sort_by_execution_order'])
+    except ImportError:
+        print('graph_transforms not available, constants are not folded')
+    return graph_def
+
+def export(checkpoint, out_dir, attention_window=0, attention_fallback=0.2):
+    weights, _ = read_checkpoint(checkpoint)
+    folded = fold_batch_norm(weights)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.placeholder(tf.float32, shape=[None, None, None, 1], name='x')
+        x_mask = tf.placeholder(tf.float32, shape=[None, None, None], name='x_mask')
+        # training=False as a python bool: dropout and batch norm branches are never built
+        wap, annotation, anno_mask = build_wap(x, x_mask, False, fold_bn=True, attention_window=attention_window,
+            attention_fallback=attention_fallback)
+        channels = annotation.shape.as_list()[3]
+
+        tf.identity(annotation, name='annotation')
+        tf.identity(anno_mask, name='anno_mask')
+        tf.identity(wap.attender.get_watch_vector(annotation), name='watch')
+        tf.identity(wap.get_h0(annotation, anno_mask), name='h_0')
+
+        anno = tf.placeholder(tf.float32, shape=[None, None, None, channels], name='step_annotation')
+        anno_m = tf.placeholder(tf.float32, shape=[None, None, None], name='step_anno_mask')
+        watch = tf.placeholder(tf.float32, shape=[None, None, None, wap.attender.dim_attend], name='step_watch')
+        infer_y = tf.placeholder(tf.int64, shape=(None,), name='step_y')
+        h_pre = tf.placeholder(tf.float32, shape=[None, wap.hidden_dim], name='step_h_pre')
+        alpha_past = tf.placeholder(tf.float32, shape=[None, None, None], name='step_alpha_past')
+        p, _, h, alpha = wap.get_word(infer_y, h_pre, alpha_past, anno, anno_m, watch)
+        tf.identity(p, name='step_probs')
+        tf.identity(h, name='step_h')
+        tf.identity(alpha, name='step_alpha_past_out')
+
+        with tf.Session(graph=graph) as sess:
+            missing = []
+            for v in tf.global_variables():
+                if v.name in folded:
+                    v.load(folded[v.name], sess)
+                else:
+                    missing.append(v.name)
+            if missing:
+                raise ValueError('checkpoint lacks %s' % ', '.join(missing))
+
+            if not os.path.isdir(out_dir):
+                os.makedirs(out_dir)
+            specs = {
+                'encoder.pb': (['x', 'x_mask'], ['annotation', 'anno_mask', 'watch', 'h_0']),
+                'decoder_step.pb': (['step_annotation', 'step_anno_mask', 'step_watch', 'step_y', 'step_h_pre', 'step_alpha_past'],
+                    ['step_probs', 'step_h', 'step_alpha_past_out']),
+            }
+            for filename, (inputs, outputs) in specs.items():
+                graph_def = freeze(sess, outputs)
+                with open(os.path.join(out_dir, filename), 'wb') as fp:
+                    fp.write(graph_def.SerializeToString())
+                print(filename, len(graph_def.node), 'nodes')
+            with open(os.path.join(out_dir, 'signature.json'), 'w') as fp:
+                json.dump(dict((f, {'inputs': [n + ':0' for n in i], 'outputs': [n + ':0' for n in o]})
+                    for f, (i, o) in specs.items()), fp, indent=2)
+
+def load_frozen(path, graph=None, name=''):
+    #### import a frozen .pb, tensors keep the names listed in signature.json under the `name` scope ####
+    graph_def = tf.GraphDef()
+    with open(path, 'rb') as fp:
+        graph_def.ParseFromString(fp.read())
+    graph = graph or tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name=name)
+    return graph
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoint")                   # models/wap.pkl or models/wap-best.pkl written by main.py
+    parser.add_argument("out_dir")
+    parser.add_argument("--attention_window", type=int, default=0)   # as the model was evaluated with in main.py
+    parser.add_argument("--attention_fallback", type=float, default=0.2)
+    args = parser.parse_args()
+    export(args.checkpoint, args.out_dir, args.attention_window, args.attention_fallback)
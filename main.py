@@ -3,11 +3,16 @@ from tensorflow.contrib.layers import batch_norm
 from tensorflow.contrib.framework import arg_scope
 import numpy as np
 import numpy
-from data import dataIterator, load_dict, prepare_data
+from data import dataIterator, load_dict, prepare_data, BatchBuffers, BatchPrefetcher, padding_ratio
+from decode import DecodePool, save_weights
+from wer import StreamingScorer
+from checkpoint import CheckpointWriter, snapshot, restore, read_checkpoint
+from cache import AnnotationCache
+from metrics import PhaseTimer
+from tensorflow.python.client import timeline
 import random
 import sys
 import copy
-import re
 import os
 import time
 import math
@@ -43,7 +48,9 @@ class Watcher_train():
                 transition=0.5,            # Compression rate
                 input_conv_filters=48,     # Number of filters of conv2d before dense blocks
                 input_conv_stride=2,       # Stride of conv2d placed before dense blocks
-                input_conv_kernel=[7,7]):  # Size of kernel of conv2d placed before dense blocks
+                input_conv_kernel=[7,7],   # Size of kernel of conv2d placed before dense blocks
+                fold_bn=False,             # inference only: batch norm folded into conv kernel + bias
+                memory_efficient=False):   # recompute concat + bottleneck in backprop instead of storing them
         self.blocks = blocks
         self.level = level
         self.growth_rate = growth_rate
@@ -54,6 +61,8 @@ class Watcher_train():
         self.input_conv_filters = input_conv_filters
         self.input_conv_stride = input_conv_stride
         self.input_conv_kernel = input_conv_kernel
+        self.fold_bn = fold_bn
+        self.memory_efficient = memory_efficient
 
     #Bound function for weight initialisation
     def bound(self, nin, nout, kernel):
@@ -66,22 +75,31 @@ class Watcher_train():
         result = np.sqrt(result)
         return result
 
+    def batch_norm_layer(self, channels):
+        return tf.layers.BatchNormalization(momentum=0.9, scale=True, gamma_initializer=tf.random_uniform_initializer(-1.0/math.sqrt(channels),
+            1.0/math.sqrt(channels), dtype=tf.float32), epsilon=0.0001)
+
+    def batch_norm(self, x, channels):
+        #### batch norm after every conv; with fold_bn its scale/shift already live in that conv's kernel and bias ####
+        if self.fold_bn:
+            return x
+        return self.batch_norm_layer(channels)(x, training=self.training)
+
     def before_dense_net(self,input_x,mask_x):
         #### before flowing into dense blocks ####
         x = input_x
         limit = self.bound(1, self.input_conv_filters, self.input_conv_kernel)
         x = tf.layers.conv2d(x, filters=self.input_conv_filters, strides=self.input_conv_stride,
-        kernel_size=self.input_conv_kernel, padding='SAME', data_format='channels_last', use_bias=False, kernel_initializer=tf.random_uniform_initializer(-limit, limit, dtype=tf.float32))
+        kernel_size=self.input_conv_kernel, padding='SAME', data_format='channels_last', use_bias=self.fold_bn, kernel_initializer=tf.random_uniform_initializer(-limit, limit, dtype=tf.float32))
         mask_x = mask_x[:, 0::2, 0::2]
-        x = tf.layers.batch_normalization(x, training=self.training, momentum=0.9, scale=True, gamma_initializer=tf.random_uniform_initializer(-1.0/math.sqrt(self.input_conv_filters),
-            1.0/math.sqrt(self.input_conv_filters), dtype=tf.float32), epsilon=0.0001)
+        x = self.batch_norm(x, self.input_conv_filters)
         x = tf.nn.relu(x)
         x = tf.layers.max_pooling2d(inputs=x, pool_size=[2,2], strides=2, padding='SAME')
         # input_pre = x
         mask_x = mask_x[:, 0::2, 0::2]
         self.dense_channels += self.input_conv_filters
         dense_out = x
-        return mask_x , dense_out
+        return x, mask_x , dense_out
     
     def bottleneck(self,x):
         ##---------------------Bottleneck layer to improve computational efficiency,i.e.,to reduce the input to 4k feature maps.(k=24)------------------##
@@ -89,19 +107,40 @@ class Watcher_train():
         filter_size = [1,1]
         limit = self.bound(self.dense_channels, 4 * self.growth_rate, filter_size)
         x = tf.layers.conv2d(x, filters=4 * self.growth_rate, kernel_size=filter_size,
-            strides=1, padding='VALID', data_format='channels_last', use_bias=False, kernel_initializer=tf.random_uniform_initializer(-limit, limit, dtype=tf.float32))
-        x = tf.layers.batch_normalization(inputs=x,  training=self.training, momentum=0.9, scale=True, gamma_initializer=tf.random_uniform_initializer(-1.0/math.sqrt(4 * self.growth_rate),
-            1.0/math.sqrt(4 * self.growth_rate), dtype=tf.float32), epsilon=0.0001)
+            strides=1, padding='VALID', data_format='channels_last', use_bias=self.fold_bn, kernel_initializer=tf.random_uniform_initializer(-limit, limit, dtype=tf.float32))
+        x = self.batch_norm(x, 4 * self.growth_rate)
         x = tf.nn.relu(x)
         x = tf.layers.dropout(inputs=x, rate=self.dropout_rate, training=self.training)
         return x
-    
+
+    def shared_bottleneck(self, features):
+        #### bottleneck over the list of level outputs: concat -> [1, 1] conv -> BN -> ReLU is recomputed ####
+        #### during backprop, so only the growth_rate wide outputs of every level stay in memory ####
+        filter_size = [1,1]
+        limit = self.bound(self.dense_channels, 4 * self.growth_rate, filter_size)
+        conv = tf.layers.Conv2D(filters=4 * self.growth_rate, kernel_size=filter_size,
+            strides=1, padding='VALID', data_format='channels_last', use_bias=self.fold_bn, kernel_initializer=tf.random_uniform_initializer(-limit, limit, dtype=tf.float32))
+        norm = None if self.fold_bn else self.batch_norm_layer(4 * self.growth_rate)
+
+        # layers are built on the first call and reused by the recomputation, so variable names match the stored mode
+        # (the recomputed batch norm adds a second set of moving average updates to UPDATE_OPS; they are never run)
+        def segment(*features):
+            x = conv(tf.concat(features, axis=3))
+            if norm is not None:
+                x = norm(x, training=self.training)
+            return tf.nn.relu(x)
+
+        x = tf.contrib.layers.recompute_grad(segment)(*features)
+        # dropout stays outside: a recomputed mask would differ from the forward one
+        x = tf.layers.dropout(inputs=x, rate=self.dropout_rate, training=self.training)
+        return x
+
     def convolution_layer_in_DenseB(self,x):
         #### [3, 3] filter for regular convolution layer
         filter_size = [3,3]
         limit = self.bound(4 * self.growth_rate, self.growth_rate,filter_size )
         x = tf.layers.conv2d(x, filters=self.growth_rate, kernel_size=filter_size,
-            strides=1, padding='SAME', data_format='channels_last', use_bias=False, kernel_initializer=tf.random_uniform_initializer(-limit, limit, dtype=tf.float32))
+            strides=1, padding='SAME', data_format='channels_last', use_bias=self.fold_bn, kernel_initializer=tf.random_uniform_initializer(-limit, limit, dtype=tf.float32))
         return x
       
     def transition_layer(self,x,mask_x):
@@ -111,9 +150,8 @@ class Watcher_train():
         self.dense_channels = compressed_channels
         limit = self.bound(self.dense_channels, compressed_channels, [1,1])
         x = tf.layers.conv2d(x, filters=compressed_channels, kernel_size=[1,1],
-            strides=1, padding='VALID', data_format='channels_last', use_bias=False, kernel_initializer=tf.random_uniform_initializer(-limit, limit, dtype=tf.float32))
-        x = tf.layers.batch_normalization(x, training=self.training, momentum=0.9, scale=True, gamma_initializer=tf.random_uniform_initializer(-1.0/math.sqrt(self.dense_channels),
-                1.0/math.sqrt(self.dense_channels), dtype=tf.float32), epsilon=0.0001)
+            strides=1, padding='VALID', data_format='channels_last', use_bias=self.fold_bn, kernel_initializer=tf.random_uniform_initializer(-limit, limit, dtype=tf.float32))
+        x = self.batch_norm(x, self.dense_channels)
         x = tf.nn.relu(x)
         x = tf.layers.dropout(inputs=x, rate=self.dropout_rate, training=self.training)
         x = tf.layers.average_pooling2d(inputs=x, pool_size=[2,2], strides=2, padding='SAME')
@@ -124,23 +162,34 @@ class Watcher_train():
     def DenseB_and_transition_layer(self,x,mask_x,dense_out):
         #### flowing into dense blocks and transition_layer ####
         for i in range(self.blocks):
+            features = [dense_out]
             for j in range(self.level):
                 ##----------------------------------------------------------DenseB Layer---------------------------------------------------------------------------##
                 #### Bottleneck layer ####
-                x = self.bottleneck(x)
+                if self.memory_efficient:
+                    x = self.shared_bottleneck(features)
+                else:
+                    x = self.bottleneck(x)
                 #### 3x3 Convolution Layer ####
                 x = self.convolution_layer_in_DenseB(x)
                 #### Batch Normalisation Layer ####
-                x = tf.layers.batch_normalization(inputs=x, training=self.training, momentum=0.9, scale=True, gamma_initializer=tf.random_uniform_initializer(-1.0/math.sqrt(self.growth_rate),
-                    1.0/math.sqrt(self.growth_rate), dtype=tf.float32), epsilon=0.0001)
+                x = self.batch_norm(x, self.growth_rate)
                 #### Relu Activation Layer ####
                 x = tf.nn.relu(x)
                 x = tf.layers.dropout(inputs=x, rate=self.dropout_rate, training=self.training)
-                dense_out = tf.concat([dense_out, x], axis=3)
-                x = dense_out
+                if self.memory_efficient:
+                    features.append(x)
+                else:
+                    dense_out = tf.concat([dense_out, x], axis=3)
+                    x = dense_out
                 #### calculate the filter number of dense block's output ####
                 self.dense_channels += self.growth_rate
 
+            if self.memory_efficient:
+                # one concat per block instead of one per level
+                dense_out = tf.concat(features, axis=3)
+                x = dense_out
+
             if i < self.blocks - 1:
                 ##---------------------------------------------------------Transition Layer------------------------------------------------------------------------##
                 x,dense_out,mask_x = self.transition_layer(x,mask_x)
@@ -151,13 +200,20 @@ class Watcher_train():
         #### before flowing into dense blocks ####
         x,mask_x ,dense_out = self.before_dense_net(input_x, mask_x)
         #### flowing into dense blocks and transition_layer ####
-        mask_x ,dense_out = self.DenseB_and_transition_layer(x,mask_x,dense_out)
+        if self.memory_efficient:
+            # recompute_grad only tracks resource variables
+            with tf.variable_scope(tf.get_variable_scope(), use_resource=True):
+                mask_x ,dense_out = self.DenseB_and_transition_layer(x,mask_x,dense_out)
+        else:
+            mask_x ,dense_out = self.DenseB_and_transition_layer(x,mask_x,dense_out)
         return dense_out, mask_x  
       
 
 class Attender():
     def __init__(self, channels,                                # output of Watcher | [batch, h, w, channels]
-                dim_decoder, dim_attend):                       # decoder hidden state:$h_{t-1}$ | [batch, dec_dim]
+                dim_decoder, dim_attend,                        # decoder hidden state:$h_{t-1}$ | [batch, dec_dim]
+                window=0,                                       # annotation columns scored per decoding step, 0: whole map
+                fallback_mass=0.2):                             # weight on the inner window edges that triggers the full map
 
         self.channels = channels
 
@@ -184,7 +240,32 @@ class Attender():
 
         self.alpha_past_filter = tf.Variable(conv_norm_weight(1, self.dim_attend, self.coverage_kernel), name='alpha_past_filter')
 
-    def get_context(self, annotation4ctx, h_t_1, alpha_past4ctx, a_mask):
+        #### windowed attention of the decoders; the training cost always attends over the whole map ####
+        self.window = window
+        self.frontier_mass = 0.5                                # column coverage that counts as already read
+        self.fallback_mass = fallback_mass
+
+    def get_watch_vector(self, annotation4ctx):
+        #### $U_a x a_i$ only depends on the annotation: compute it once per image, not once per step ####
+        return tf.tensordot(annotation4ctx, self.U_a, axes=1) \
+        + self.U_a_b                                            # [batch, h, w, dim_attend]
+
+    def get_context(self, annotation4ctx, h_t_1, alpha_past4ctx, a_mask, watch_vector=None, dense=False):
+
+        #### calculate $U_a x a_i$ unless the caller hoisted it ####
+        if watch_vector is None:
+            watch_vector = self.get_watch_vector(annotation4ctx)
+
+        if self.window > 0 and not dense:
+            context, alpha = self.windowed_attention(annotation4ctx, h_t_1, alpha_past4ctx, a_mask, watch_vector)
+        else:
+            context, alpha = self.dense_attention(annotation4ctx, h_t_1, alpha_past4ctx, a_mask, watch_vector)
+
+        alpha_past4ctx += alpha                                 # accumalated weights matrix | [batch, h, w]
+
+        return context, alpha, alpha_past4ctx
+
+    def dense_attention(self, annotation4ctx, h_t_1, alpha_past4ctx, a_mask, watch_vector):
 
         #### calculate $U_f x f_i$ ####
         alpha_past_4d = alpha_past4ctx[:, :, :, None]
@@ -194,10 +275,6 @@ class Attender():
         coverage_vector = tf.tensordot(Ft, self.U_f, axes=1) \
         + self.U_f_b                                            # [batch, h, w, dim_attend]
 
-        #### calculate $U_a x a_i$ ####
-        watch_vector = tf.tensordot(annotation4ctx, self.U_a, axes=1) \
-        + self.U_a_b                                            # [batch, h, w, dim_attend]
-
         #### calculate $W_a x h_{t - 1}$ ####
         speller_vector = tf.tensordot(h_t_1, self.W_a, axes=1) \
         + self.W_a_b                                            # [batch, dim_attend]
@@ -218,12 +295,65 @@ class Attender():
         alpha = alpha / tf.reduce_sum(alpha, \
             axis=[1, 2], keepdims=True)                         # normlized weights | [batch, h, w]
 
-        alpha_past4ctx += alpha                                 # accumalated weights matrix | [batch, h, w]
-
         context = tf.reduce_sum(annotation4ctx * alpha[:, :, :, None], \
             axis=[1, 2])                                        # context vector | [batch, feature_channels]
 
-        return context, alpha, alpha_past4ctx
+        return context, alpha
+
+    def gather_columns(self, x, cols):
+        #### x[b, :, cols[b], :] for every row b of cols; x may hold a single image shared by all rows ####
+        return tf.cond(tf.equal(tf.shape(x)[0], tf.shape(cols)[0]),
+            lambda: tf.gather(x, cols, axis=2, batch_dims=1),
+            lambda: tf.transpose(tf.gather(x[0], cols, axis=1), [1, 0, 2, 3]))    # [batch, h, window, ...]
+
+    def windowed_attention(self, annotation4ctx, h_t_1, alpha_past4ctx, a_mask, watch_vector):
+        #### score only `window` columns starting a third of a window left of the coverage frontier, i.e. the ####
+        #### rightmost column already holding frontier_mass coverage; rows that put more than fallback_mass ####
+        #### on the inner edges of their window are recomputed over the whole map ####
+        shape = tf.shape(alpha_past4ctx)                        # [batch, h, w]
+        width = shape[2]
+        window = tf.minimum(self.window, width)
+        pad_h = self.coverage_kernel[0] // 2
+        pad_w = self.coverage_kernel[1] // 2
+
+        column_coverage = tf.reduce_sum(alpha_past4ctx, axis=1) # [batch, w]
+        frontier = tf.reduce_max(tf.cast(column_coverage >= self.frontier_mass, tf.int32) * tf.range(width)[None, :], axis=1)
+        start = tf.clip_by_value(frontier - window // 3, 0, width - window)
+        cols = start[:, None] + tf.range(window)[None, :]       # [batch, window]
+
+        #### $U_f x f_i$ on the window: the coverage conv sees pad_w extra columns on both sides ####
+        alpha_past_pad = tf.pad(alpha_past4ctx, [[0, 0], [0, 0], [pad_w, pad_w]])[:, :, :, None]
+        alpha_past_win = self.gather_columns(alpha_past_pad, start[:, None] + tf.range(window + 2 * pad_w)[None, :])
+        alpha_past_win = tf.pad(alpha_past_win, [[0, 0], [pad_h, pad_h], [0, 0], [0, 0]])
+        Ft = tf.nn.conv2d(alpha_past_win, filter=self.alpha_past_filter, strides=[1, 1, 1, 1], padding='VALID')
+        coverage_vector = tf.tensordot(Ft, self.U_f, axes=1) \
+        + self.U_f_b                                            # [batch, h, window, dim_attend]
+
+        speller_vector = tf.tensordot(h_t_1, self.W_a, axes=1) \
+        + self.W_a_b
+        speller_vector = speller_vector[:, None, None, :]
+
+        tanh_vector = tf.tanh(
+            coverage_vector + self.gather_columns(watch_vector, cols) + speller_vector)
+        e_ti = tf.tensordot(tanh_vector, self.V_a, axes=1) + self.V_a_b  # [batch, h, window, 1]
+        alpha_win = tf.squeeze(tf.exp(e_ti), axis=3)
+        if a_mask is not None:
+            alpha_win = alpha_win * self.gather_columns(a_mask[:, :, :, None], cols)[:, :, :, 0]
+        alpha_win = alpha_win / tf.reduce_sum(alpha_win, axis=[1, 2], keepdims=True)
+
+        context = tf.reduce_sum(self.gather_columns(annotation4ctx, cols) * alpha_win[:, :, :, None], axis=[1, 2])
+        alpha = tf.einsum('bhj,bjw->bhw', alpha_win, tf.one_hot(cols, width))         # back onto the full map
+
+        #### edges that coincide with the map edge cannot hide attention ####
+        edge_mass = tf.reduce_sum(alpha_win[:, :, 0], axis=1) * tf.cast(start > 0, tf.float32) \
+            + tf.reduce_sum(alpha_win[:, :, -1], axis=1) * tf.cast(start + window < width, tf.float32)
+        fallback = edge_mass > self.fallback_mass
+
+        def full_map():
+            dense_context, dense_alpha = self.dense_attention(annotation4ctx, h_t_1, alpha_past4ctx, a_mask, watch_vector)
+            return tf.where(fallback, dense_context, context), tf.where(fallback, dense_alpha, alpha)
+
+        return tf.cond(tf.reduce_any(fallback), full_map, lambda: (context, alpha))
 
 
 class WAP():
@@ -250,13 +380,25 @@ class WAP():
         self.bo = tf.Variable(np.zeros((self.target_dim,)).astype('float32'), name='bo')
         self.training = training
 
-    def get_word(self, sample_y, sample_h_pre, alpha_past_pre, sample_annotation):
+    def get_h0(self, annotation, a_m):
+        #### initial decoder state from the masked mean of the annotation ####
+        anno_mean = tf.reduce_sum(annotation * a_m[:, :, :, None], axis=[1, 2]) / tf.reduce_sum(a_m, axis=[1, 2])[:, None]
+        h_0 = tf.tensordot(anno_mean, self.Wa2h, axes=1) + self.ba2h  # [batch, hidden_dim]
+        return tf.tanh(h_0)
+
+    def get_word(self, sample_y, sample_h_pre, alpha_past_pre, sample_annotation, sample_anno_mask=None, sample_watch=None, dense=False):
 
         emb = tf.cond(sample_y[0] < 0,
-            lambda: tf.fill((1, self.word_dim), 0.0),
+            lambda: tf.fill((tf.shape(sample_y)[0], self.word_dim), 0.0),
             lambda: tf.nn.embedding_lookup(self.embed_matrix, sample_y)
             )
 
+        next_probs, h_t, alpha_past_t = self.get_step(emb, sample_h_pre, alpha_past_pre, sample_annotation, sample_anno_mask, sample_watch, dense)
+        next_word  = tf.reduce_max(tf.multinomial(next_probs, num_samples=1), axis=1)
+        return next_probs, next_word, h_t, alpha_past_t
+
+    def get_step(self, emb, sample_h_pre, alpha_past_pre, sample_annotation, sample_anno_mask=None, sample_watch=None, dense=False):
+        #### one decoder step from the previous word embedding, shared by every decoding path ####
         #ret = self.parser.one_time_step((h_pre, None, None, alpha_past_pre, annotation, None), (emb, None))
         emb_y_z_r_vector = tf.tensordot(emb, self.parser.W_yz_yr, axes=1) + \
         self.parser.b_yz_yr                                            # [batch, 2 * dim_decoder]
@@ -277,7 +419,7 @@ class WAP():
 
         pre_h = z1 * sample_h_pre + (1. - z1) * pre_h_proposal
 
-        context, _, alpha_past = self.parser.attender.get_context(sample_annotation, pre_h, alpha_past_pre, None)  # [batch, dim_ctx]
+        context, _, alpha_past = self.parser.attender.get_context(sample_annotation, pre_h, alpha_past_pre, sample_anno_mask, sample_watch, dense)  # [batch, dim_ctx]
         emb_y_z_r_nl_vector = tf.tensordot(pre_h, self.parser.U_hz_hr_nl, axes=1) + self.parser.b_hz_hr_nl
         context_z_r_vector = tf.tensordot(context, self.parser.W_c_z_r, axes=1)
         z_r_vector = tf.sigmoid(emb_y_z_r_nl_vector + context_z_r_vector)
@@ -309,8 +451,7 @@ class WAP():
         logit = tf.tensordot(logit, self.Wo, axes=1) + self.bo
 
         next_probs = tf.nn.softmax(logits=logit)
-        next_word  = tf.reduce_max(tf.multinomial(next_probs, num_samples=1), axis=1)
-        return next_probs, next_word, h_t, alpha_past_t
+        return next_probs, h_t, alpha_past_t
 
     def get_cost(self, cost_annotation, cost_y, a_m, y_m):
         timesteps = tf.shape(cost_y)[0]
@@ -320,9 +461,7 @@ class WAP():
         emb_pad = tf.fill((1, batch_size, self.word_dim), 0.0)
         emb_shift = tf.concat([emb_pad ,tf.strided_slice(emb_y, [0, 0, 0], [-1, batch_size, self.word_dim], [1, 1, 1])], axis=0)
         new_emb_y = emb_shift
-        anno_mean = tf.reduce_sum(cost_annotation * a_m[:, :, :, None], axis=[1, 2]) / tf.reduce_sum(a_m, axis=[1, 2])[:, None]
-        h_0 = tf.tensordot(anno_mean, self.Wa2h, axes=1) + self.ba2h  # [batch, hidden_dim]
-        h_0 = tf.tanh(h_0)
+        h_0 = self.get_h0(cost_annotation, a_m)
 
         ret = self.parser.get_ht_ctx(new_emb_y, h_0, cost_annotation, a_m, y_m)
         h_t = ret[0]                      # h_t of all timesteps [timesteps, batch, word_dim]
@@ -353,7 +492,202 @@ class WAP():
         return cost
 
 
-    def get_sample(self, anno, infer_y, h_pre, alpha_past, if_trainning, p, w, h, alpha, ctx0, h_0, k , maxlen, stochastic, session, training):
+    def get_sample_graph(self, sample_annotation, k, maxlen):
+        #### whole beam search for one image inside a tf.while_loop, decoded with a single session.run ####
+        # sample_annotation: [1, h, w, channels]; it broadcasts against the k beam rows in the attention
+        big = 1e10                                              # score of empty beam / pool slots
+        shape = tf.shape(sample_annotation)
+        h_0 = tf.tile(self.get_h0(sample_annotation, tf.ones(shape[:3])), [k, 1])
+        sample_watch = self.attender.get_watch_vector(sample_annotation)  # loop invariant
+
+        init = (tf.constant(0),
+            -tf.ones([k], dtype=tf.int32),                      # previous word, -1 is the empty start embedding
+            h_0,
+            tf.zeros([k, shape[1], shape[2]]),                  # alpha_past
+            tf.concat([tf.zeros([1]), tf.fill([k - 1], big)], axis=0), # only one live hypothesis at t = 0
+            tf.zeros([k, maxlen], dtype=tf.int32),              # live sequences
+            tf.constant(0),                                     # dead_k
+            tf.zeros([k, maxlen], dtype=tf.int32),              # finished sequences
+            tf.fill([k], big),                                  # finished scores
+            tf.zeros([k], dtype=tf.int32))                      # finished lengths
+
+        def push(pool_seqs, pool_scores, pool_lens, dead_k, take, seqs, scores, lens):
+            #### scatter the rows flagged in `take` into the finished pool, starting at slot dead_k ####
+            pos = dead_k + tf.cumsum(tf.cast(take, tf.int32)) - 1
+            sel = tf.one_hot(pos, k) * tf.cast(take, tf.float32)[:, None]   # [candidate, slot]
+            sel_i = tf.cast(sel, tf.int32)
+            hit = tf.reduce_sum(sel, axis=0)
+            hit_i = tf.cast(hit, tf.int32)
+            pool_scores = pool_scores * (1. - hit) + tf.reduce_sum(sel * scores[:, None], axis=0)
+            pool_seqs = pool_seqs * (1 - hit_i)[:, None] + tf.reduce_sum(sel_i[:, :, None] * seqs[:, None, :], axis=0)
+            pool_lens = pool_lens * (1 - hit_i) + tf.reduce_sum(sel_i * lens[:, None], axis=0)
+            return pool_seqs, pool_scores, pool_lens, dead_k + tf.reduce_sum(tf.cast(take, tf.int32))
+
+        def cond(t, y, h_pre, alpha_past_pre, scores, seqs, dead_k, fin_seqs, fin_scores, fin_lens):
+            return tf.logical_and(tf.logical_and(t < maxlen, dead_k < k), tf.reduce_min(scores) < big)
+
+        def body(t, y, h_pre, alpha_past_pre, scores, seqs, dead_k, fin_seqs, fin_scores, fin_lens):
+            emb = tf.where(y < 0, tf.zeros([k, self.word_dim]),
+                tf.nn.embedding_lookup(self.embed_matrix, tf.maximum(y, 0)))
+            next_probs, h_t, alpha_past_t = self.get_step(emb, h_pre, alpha_past_pre, sample_annotation, None, sample_watch)
+            voc_size = tf.shape(next_probs)[1]
+
+            cand_flat = tf.reshape(scores[:, None] - tf.log(next_probs), [-1])
+            neg_costs, ranks_flat = tf.nn.top_k(-cand_flat, k=k)
+            costs = -neg_costs
+            trans_indices = ranks_flat // voc_size
+            word_indices = ranks_flat % voc_size
+
+            # like the host-side search, only the best k - dead_k candidates survive
+            valid = tf.logical_and(tf.range(k) < k - dead_k, costs < big)
+            ended = tf.logical_and(valid, tf.equal(word_indices, 0))  # <eol>
+            live = tf.logical_and(valid, tf.not_equal(word_indices, 0))
+
+            new_seqs = tf.gather(seqs, trans_indices) + tf.one_hot(t, maxlen, dtype=tf.int32)[None, :] * word_indices[:, None]
+            fin_seqs, fin_scores, fin_lens, dead_k = push(fin_seqs, fin_scores, fin_lens, dead_k,
+                ended, new_seqs, costs, tf.fill([k], t + 1))
+
+            return (t + 1,
+                tf.where(live, word_indices, tf.zeros([k], dtype=tf.int32)),
+                tf.gather(h_t, trans_indices),
+                tf.gather(alpha_past_t, trans_indices),
+                tf.where(live, costs, tf.fill([k], big)),
+                new_seqs, dead_k, fin_seqs, fin_scores, fin_lens)
+
+        t, _, _, _, scores, seqs, dead_k, fin_seqs, fin_scores, fin_lens = tf.while_loop(cond, body, init, back_prop=False)
+
+        # dump every remaining one
+        fin_seqs, fin_scores, fin_lens, _ = push(fin_seqs, fin_scores, fin_lens, dead_k,
+            scores < big, seqs, scores, tf.fill([k], t))
+
+        norm_scores = tf.where(fin_scores < big, fin_scores / tf.cast(tf.maximum(fin_lens, 1), tf.float32), tf.fill([k], big))
+        best = tf.argmin(norm_scores, axis=0, output_type=tf.int32)
+        return fin_seqs[best, :fin_lens[best]], fin_seqs, fin_scores, fin_lens
+
+    def build_resident_decoder(self, sample_annotation):
+        #### beam search step whose annotation, projection and beam states stay in graph variables ####
+        # load: keep one image's annotation (e.g. the encoder output itself) resident for the whole search
+        # step: gather h / alpha_past by backpointer in the graph, run one step, store the new states back
+        channels = sample_annotation.shape.as_list()[3]
+        shape = tf.shape(sample_annotation)
+        resident = lambda name, rank: tf.Variable(tf.zeros([1] * rank), name=name, trainable=False,
+            validate_shape=False, collections=[])       # not checkpointed, only written by load / step
+        res_anno = resident('res_anno', 4)
+        res_watch = resident('res_watch', 4)
+        res_h = resident('res_h', 2)
+        res_alpha_past = resident('res_alpha_past', 3)
+
+        load = tf.group(
+            tf.assign(res_anno, sample_annotation, validate_shape=False),
+            tf.assign(res_watch, self.attender.get_watch_vector(sample_annotation), validate_shape=False),
+            tf.assign(res_h, self.get_h0(sample_annotation, tf.ones(shape[:3])), validate_shape=False),
+            tf.assign(res_alpha_past, tf.zeros(shape[:3]), validate_shape=False))
+
+        beam_parent = tf.placeholder(tf.int32, shape=(None,))   # row of the previous step every live hypothesis extends
+        beam_y = tf.placeholder(tf.int64, shape=(None,))
+
+        anno_v = res_anno.value()
+        anno_v.set_shape([1, None, None, channels])
+        watch_v = res_watch.value()
+        watch_v.set_shape([1, None, None, self.attender.dim_attend])
+        h_v = tf.gather(res_h.value(), beam_parent)
+        h_v.set_shape([None, self.hidden_dim])
+        alpha_past_v = tf.gather(res_alpha_past.value(), beam_parent)
+        alpha_past_v.set_shape([None, None, None])
+
+        emb = tf.cond(beam_y[0] < 0,
+            lambda: tf.fill((tf.shape(beam_y)[0], self.word_dim), 0.0),
+            lambda: tf.nn.embedding_lookup(self.embed_matrix, beam_y)
+            )
+        next_probs, h_t, alpha_past_t = self.get_step(emb, h_v, alpha_past_v, anno_v, None, watch_v)
+        with tf.control_dependencies([tf.assign(res_h, h_t, validate_shape=False),
+                                      tf.assign(res_alpha_past, alpha_past_t, validate_shape=False)]):
+            next_probs = tf.identity(next_probs)
+
+        return load, beam_parent, beam_y, next_probs
+
+    def get_sample_resident(self, load, beam_parent, beam_y, p, if_trainning, load_dict, k, maxlen, session, training):
+        #### host-side beam search over build_resident_decoder: only word ids, backpointers and probs cross the feed ####
+        sample = []
+        sample_score = []
+
+        live_k = 1
+        dead_k = 0
+
+        hyp_samples = [[]] * live_k
+        hyp_scores = np.zeros(live_k).astype('float32')
+
+        session.run(load, feed_dict=load_dict)
+
+        next_parent = np.zeros((1,)).astype('int32')
+        next_w = -1 * np.ones((1,)).astype('int64')
+
+        for ii in range(maxlen):
+
+            next_p = session.run(p, feed_dict={beam_parent:next_parent, beam_y:next_w, if_trainning:training})
+
+            cand_scores = hyp_scores[:, None] - np.log(next_p)
+            cand_flat = cand_scores.flatten()
+            ranks_flat = cand_flat.argsort()[:(k-dead_k)]
+            voc_size = next_p.shape[1]
+
+            trans_indices = ranks_flat // voc_size
+            word_indices = ranks_flat % voc_size
+            costs = cand_flat[ranks_flat]
+
+            live = word_indices != 0 # <eol>
+            for idx in np.nonzero(~live)[0]:
+                sample.append(hyp_samples[trans_indices[idx]]+[word_indices[idx]])
+                sample_score.append(costs[idx])
+            dead_k += int((~live).sum())
+
+            hyp_samples = [hyp_samples[ti]+[wi] for ti, wi in zip(trans_indices[live], word_indices[live])]
+            hyp_scores = costs[live]
+            live_k = len(hyp_samples)
+
+            if live_k < 1:
+                break
+            if dead_k >= k:
+                break
+
+            next_parent = trans_indices[live].astype('int32')
+            next_w = word_indices[live].astype('int64')
+
+        # dump every remaining one
+        for idx in range(live_k):
+            sample.append(hyp_samples[idx])
+            sample_score.append(hyp_scores[idx])
+
+        return sample, sample_score
+
+    def get_sample_greedy(self, sample_annotation, sample_anno_mask, maxlen):
+        #### batched greedy decoding in one tf.while_loop, every row stops at its own <eol> ####
+        n_samples = tf.shape(sample_annotation)[0]
+        sample_watch = self.attender.get_watch_vector(sample_annotation)
+
+        init = (tf.constant(0),
+            -tf.ones([n_samples], dtype=tf.int32),
+            self.get_h0(sample_annotation, sample_anno_mask),
+            tf.zeros_like(sample_anno_mask),
+            tf.zeros([n_samples], dtype=tf.bool),
+            tf.TensorArray(tf.int32, size=0, dynamic_size=True))
+
+        def cond(t, y, h_pre, alpha_past_pre, done, words):
+            return tf.logical_and(t < maxlen, tf.logical_not(tf.reduce_all(done)))
+
+        def body(t, y, h_pre, alpha_past_pre, done, words):
+            emb = tf.where(y < 0, tf.zeros([n_samples, self.word_dim]),
+                tf.nn.embedding_lookup(self.embed_matrix, tf.maximum(y, 0)))
+            next_probs, h_t, alpha_past_t = self.get_step(emb, h_pre, alpha_past_pre, sample_annotation, sample_anno_mask, sample_watch)
+            next_word = tf.argmax(next_probs, axis=1, output_type=tf.int32)
+            next_word = tf.where(done, tf.zeros_like(next_word), next_word)   # finished rows keep emitting <eol>
+            return t + 1, next_word, h_t, alpha_past_t, tf.logical_or(done, tf.equal(next_word, 0)), words.write(t, next_word)
+
+        _, _, _, _, _, words = tf.while_loop(cond, body, init, back_prop=False)
+        return tf.transpose(words.stack())                      # [batch, steps]
+
+    def get_sample(self, anno, infer_y, h_pre, alpha_past, if_trainning, p, w, h, alpha, ctx0, h_0, k , maxlen, stochastic, session, training,
+                   watch=None, watch0=None, argmax=False):
 
         sample = []
         sample_score = []
@@ -383,6 +717,8 @@ class WAP():
             h_pre:next_state,
             if_trainning:training
             }
+            if watch is not None:
+                input_dict[watch] = watch0              # hoisted $U_a x a_i$ of the image, broadcast over the beam
 
             next_p, next_w, next_state, next_alpha_past = session.run([p, w, h, alpha], feed_dict=input_dict)
 
@@ -392,7 +728,7 @@ class WAP():
                 else:
                     nw = next_w[0]
                 sample.append(nw)
-                sample_score += next_p[0, nw]
+                sample_score.append(next_p[0, nw])
                 if nw == 0:
                     break
             else:
@@ -455,6 +791,89 @@ class WAP():
 
         return sample, sample_score
 
+    @staticmethod
+    def get_sample_batch(anno, anno_m, infer_y, h_pre, alpha_past, if_trainning, p, h, alpha, ctx0, ctx_mask, h_0, k, maxlen, session, training,
+                         watch=None, watch0=None):
+        #### beam search over N padded images at once: the live hypotheses of every image share one flat batch ####
+        n_images = ctx0.shape[0]
+        sample = [[] for _ in range(n_images)]
+        sample_score = [[] for _ in range(n_images)]
+        dead_k = np.zeros(n_images, dtype='int64')
+
+        hyp_images = np.arange(n_images)                       # image index of every live row
+        hyp_samples = [[] for _ in range(n_images)]
+        hyp_scores = np.zeros(n_images).astype('float32')
+
+        next_alpha_past = np.zeros(ctx_mask.shape).astype('float32')
+        next_w = -1 * np.ones((n_images,)).astype('int64')
+        next_state = h_0
+
+        for ii in range(maxlen):
+
+            input_dict = {
+            anno:ctx0[hyp_images],
+            anno_m:ctx_mask[hyp_images],
+            infer_y:next_w,
+            alpha_past:next_alpha_past,
+            h_pre:next_state
+            }
+            if if_trainning is not None:        # frozen step graphs have no training switch
+                input_dict[if_trainning] = training
+            if watch is not None:
+                input_dict[watch] = watch0[hyp_images]
+
+            next_p, next_state, next_alpha_past = session.run([p, h, alpha], feed_dict=input_dict)
+
+            cand_scores = hyp_scores[:, None] - np.log(next_p)
+            voc_size = next_p.shape[1]
+
+            trans_indices = []
+            word_indices = []
+            costs = []
+            for ii_img in range(n_images):
+                rows = np.nonzero(hyp_images == ii_img)[0]
+                if len(rows) == 0:
+                    continue
+                cand_flat = cand_scores[rows].flatten()
+                ranks_flat = cand_flat.argsort()[:(k-dead_k[ii_img])]
+                trans_indices.append(rows[ranks_flat // voc_size])
+                word_indices.append(ranks_flat % voc_size)
+                costs.append(cand_flat[ranks_flat])
+            trans_indices = np.concatenate(trans_indices)
+            word_indices = np.concatenate(word_indices)
+            costs = np.concatenate(costs)
+
+            new_hyp_samples = []
+            live = []
+            for idx, [ti, wi] in enumerate(zip(trans_indices, word_indices)):
+                img = hyp_images[ti]
+                if wi == 0: # <eol>
+                    sample[img].append(hyp_samples[ti]+[wi])
+                    sample_score[img].append(costs[idx])
+                    dead_k[img] += 1
+                else:
+                    live.append(idx)
+                    new_hyp_samples.append(hyp_samples[ti]+[wi])
+
+            # an image keeps k - dead_k live rows, so it drops out once k hypotheses have ended
+            live = np.array(live, dtype='int64')
+            if len(live) < 1:
+                hyp_samples = []
+                break
+            hyp_samples = new_hyp_samples
+            hyp_images = hyp_images[trans_indices[live]]
+            hyp_scores = costs[live]
+            next_w = word_indices[live]
+            next_state = next_state[trans_indices[live]]
+            next_alpha_past = next_alpha_past[trans_indices[live]]
+
+        # dump every remaining one
+        for idx in range(len(hyp_samples)):
+            sample[hyp_images[idx]].append(hyp_samples[idx])
+            sample_score[hyp_images[idx]].append(hyp_scores[idx])
+
+        return sample, sample_score
+
 class Parser():
 
     def __init__(self, hidden_dim, word_dim, attender, context_dim):
@@ -492,21 +911,23 @@ class Parser():
 
     def get_ht_ctx(self, emb_y, target_hidden_state_0, annotations, a_m, y_m):
 
-        res = tf.scan(self.one_time_step, elems=(emb_y, y_m),
+        # the annotation and its attention projection are loop invariants: close over them
+        # instead of carrying them through the scan, which would also stack them per step
+        watch_vectors = self.attender.get_watch_vector(annotations)
+
+        res = tf.scan(lambda state, elems: self.one_time_step(state, elems, annotations, watch_vectors, a_m),
+            elems=(emb_y, y_m),
             initializer=(target_hidden_state_0,
                 tf.zeros([tf.shape(annotations)[0], self.context_dim]),
                 tf.zeros([tf.shape(annotations)[0], tf.shape(annotations)[1], tf.shape(annotations)[2]]),
-                tf.zeros([tf.shape(annotations)[0], tf.shape(annotations)[1], tf.shape(annotations)[2]]),
-                annotations, a_m))
+                tf.zeros([tf.shape(annotations)[0], tf.shape(annotations)[1], tf.shape(annotations)[2]])))
 
         return res
 
-    def one_time_step(self, tuple_h0_ctx_alpha_alpha_past_annotation, tuple_emb_mask):
+    def one_time_step(self, tuple_h0_ctx_alpha_alpha_past, tuple_emb_mask, annotation_one, watch_one, a_mask):
 
-        target_hidden_state_0 = tuple_h0_ctx_alpha_alpha_past_annotation[0]
-        alpha_past_one        = tuple_h0_ctx_alpha_alpha_past_annotation[3]
-        annotation_one        = tuple_h0_ctx_alpha_alpha_past_annotation[4]
-        a_mask                = tuple_h0_ctx_alpha_alpha_past_annotation[5]
+        target_hidden_state_0 = tuple_h0_ctx_alpha_alpha_past[0]
+        alpha_past_one        = tuple_h0_ctx_alpha_alpha_past[3]
 
         emb_y, y_mask = tuple_emb_mask
 
@@ -532,7 +953,7 @@ class Parser():
         if y_mask is not None:
             pre_h = y_mask[:, None] * pre_h + (1. - y_mask)[:, None] * target_hidden_state_0
 
-        context, alpha, alpha_past_one = self.attender.get_context(annotation_one, pre_h, alpha_past_one, a_mask)  # [batch, dim_ctx]
+        context, alpha, alpha_past_one = self.attender.get_context(annotation_one, pre_h, alpha_past_one, a_mask, watch_one, dense=True)  # [batch, dim_ctx]
         emb_y_z_r_nl_vector = tf.tensordot(pre_h, self.U_hz_hr_nl, axes=1) + self.b_hz_hr_nl
         context_z_r_vector = tf.tensordot(context, self.W_c_z_r, axes=1)
         z_r_vector = tf.sigmoid(emb_y_z_r_nl_vector + context_z_r_vector)
@@ -549,7 +970,22 @@ class Parser():
         if y_mask is not None:
             h = y_mask[:, None] * h + (1. - y_mask)[:, None] * pre_h
 
-        return h, context, alpha, alpha_past_one, annotation_one, a_mask
+        return h, context, alpha, alpha_past_one
+
+def build_wap(x, x_mask, if_trainning, fold_bn=False, memory_efficient=False, attention_window=0, attention_fallback=0.2):
+    #### encoder + attention decoder; variables are created in the same order in every process ####
+    watcher_train = Watcher_train(blocks=3,level=16, growth_rate=24, training=if_trainning, fold_bn=fold_bn,
+        memory_efficient=memory_efficient)
+
+    annotation, anno_mask = watcher_train.dense_net(x, x_mask)
+
+    attender = Attender(annotation.shape.as_list()[3], 256, 512, window=attention_window, fallback_mass=attention_fallback)
+
+    parser = Parser(256, 256, attender, annotation.shape.as_list()[3])
+
+    wap = WAP(watcher_train, attender, parser, 256, 256, annotation.shape.as_list()[3], 111, if_trainning)
+
+    return wap, annotation, anno_mask
 
 def main(args):
     worddicts = load_dict(args.path + '/data/dictionary.txt')
@@ -558,17 +994,29 @@ def main(args):
         worddicts_r[vv] = kk
 
     #ipdb.set_trace()
-    train, train_uid_list = dataIterator(args.path + '/data/offline-train.pkl', args.path + '/data/train_caption.txt', worddicts,
-        batch_size=args.batch_size, batch_Imagesize=400000,
-        maxlen=100, maxImagesize=400000)
+    # compiled shard directories (compile-shards.py) are memory-mapped instead of unpickled
+    train_features = args.train_shards or args.path + '/data/offline-train.pkl'
+    valid_features = args.valid_shards or args.path + '/data/offline-test.pkl'
+
+    train, train_uid_list = dataIterator(train_features, args.path + '/data/train_caption.txt', worddicts,
+        batch_size=args.batch_size, batch_Imagesize=args.batch_Imagesize,
+        maxlen=100, maxImagesize=args.maxImagesize, bucketing=args.bucketing, crop=args.crop, max_pixels=args.max_pixels)
     
     #ipdb.set_trace()
-    valid, valid_uid_list = dataIterator(args.path +  '/data/offline-test.pkl', args.path + '/data/test_caption.txt', worddicts,
-        batch_size=args.batch_size, batch_Imagesize=400000,
-        maxlen=100, maxImagesize=400000)
+    valid, valid_uid_list = dataIterator(valid_features, args.path + '/data/test_caption.txt', worddicts,
+        batch_size=args.batch_size, batch_Imagesize=args.batch_Imagesize,
+        maxlen=100, maxImagesize=args.maxImagesize, crop=args.crop, max_pixels=args.max_pixels)
 
     print('train length is ', len(train))
 
+    # reference token ids of the validation set, for streaming WER while decoding
+    valid_labels = dict(zip(valid_uid_list, [lab for batch_x, batch_y in valid for lab in batch_y]))
+
+    # reusable float32 batch buffers sized to the largest bucket of each set
+    train_buffers = BatchBuffers.from_batches(train, pool_size=args.prefetch + 2)
+    valid_buffers = BatchBuffers.from_batches(valid)
+    prefetcher = BatchPrefetcher(train_buffers, depth=args.prefetch)
+
     x = tf.placeholder(tf.float32, shape=[None, None, None, 1])
 
     y = tf.placeholder(tf.int32, shape=[None, None])
@@ -581,9 +1029,11 @@ def main(args):
 
     if_trainning = tf.placeholder(tf.bool, shape=())
 
-    watcher_train = Watcher_train(blocks=3,level=16, growth_rate=24, training=if_trainning)
-
-    annotation, anno_mask = watcher_train.dense_net(x, x_mask)
+    # every decoder scores --attention_window annotation columns per step; the training cost and the
+    # *_dense step (for --compare_decoders) keep attending over the whole map
+    wap, annotation, anno_mask = build_wap(x, x_mask, if_trainning, memory_efficient=args.memory_efficient,
+        attention_window=args.attention_window, attention_fallback=args.attention_fallback)
+    attender = wap.attender
 
     # for initilaizing validation
     anno = tf.placeholder(tf.float32, shape=[None, annotation.shape.as_list()[1], annotation.shape.as_list()[2], annotation.shape.as_list()[3]])
@@ -591,34 +1041,78 @@ def main(args):
     h_pre = tf.placeholder(tf.float32, shape=[None, 256])
     alpha_past = tf.placeholder(tf.float32, shape=[None, annotation.shape.as_list()[1], annotation.shape.as_list()[2]])
 
-    attender = Attender(annotation.shape.as_list()[3], 256, 512)
-
-    parser = Parser(256, 256, attender, annotation.shape.as_list()[3])
-
-    wap = WAP(watcher_train, attender, parser, 256, 256, annotation.shape.as_list()[3], 111, if_trainning)
-
     hidden_state_0 = tf.tanh(tf.tensordot(tf.reduce_mean(anno, axis=[1, 2]), wap.Wa2h, axes=1) + wap.ba2h)  # [batch, hidden_dim]
 
-    cost = wap.get_cost(annotation, y, anno_mask, y_mask)
+    # batched decoding of padded images needs the annotation mask in h_0 and in the attention
+    anno_m = tf.placeholder(tf.float32, shape=[None, None, None])
+    hidden_state_0_m = wap.get_h0(anno, anno_m)
+
+    data_cost = wap.get_cost(annotation, y, anno_mask, y_mask)
 
     vs = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES)
 
+    l2_cost = 0.
     for vv in vs:
         if not vv.name.startswith('batch_normalization'):
-            cost += 1e-4 * tf.reduce_sum(tf.pow(vv, 2))
-
-    p, w, h, alpha = wap.get_word(infer_y, h_pre, alpha_past, anno)
+            l2_cost += 1e-4 * tf.reduce_sum(tf.pow(vv, 2))
+    cost = data_cost + l2_cost
+
+    # $U_a x a_i$ is computed with the annotation and fed back once per image instead of per step
+    annotation_watch = attender.get_watch_vector(annotation)
+    annotation_h0 = wap.get_h0(annotation, anno_mask)            # masked mean, i.e. h_0 of every unpadded image
+    watch = tf.placeholder(tf.float32, shape=[None, None, None, attender.dim_attend])
+
+    p, w, h, alpha = wap.get_word(infer_y, h_pre, alpha_past, anno, None, watch)
+    if args.attention_window > 0:
+        p_dense, w_dense, h_dense, alpha_dense = wap.get_word(infer_y, h_pre, alpha_past, anno, None, watch, dense=True)
+    p_m, _, h_m, alpha_m = wap.get_word(infer_y, h_pre, alpha_past, anno, anno_m, watch)
+    # batched greedy decoding straight from the encoder output, one session.run per batch
+    greedy_sample = wap.get_sample_greedy(annotation, anno_mask, 100)
+    if args.graph_decode or args.compare_decoders:
+        graph_sample, _, _, _ = wap.get_sample_graph(anno, 10, 100)
+    if args.resident_decode or args.compare_decoders:
+        # loads straight from the encoder output, so the annotation never leaves the graph
+        res_load, beam_parent, beam_y, res_p = wap.build_resident_decoder(annotation)
 
     optimizer = tf.train.AdadeltaOptimizer(learning_rate=lr)
+    if args.mixed_precision:
+        # float16 convs and matmuls on float32 master weights, with a dynamic loss scale inside the optimizer:
+        # steps whose scaled gradients overflow are skipped, `cost` itself stays unscaled.
+        # Exp, Sum, Pow and the cross entropy are on the rewrite's float32 list, so the attention
+        # normalization, the cost and the L2 term are computed in float32
+        optimizer = tf.train.experimental.enable_mixed_precision_graph_rewrite(optimizer, loss_scale='dynamic')
 
     update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
 
     with tf.control_dependencies(update_ops):
         trainer = optimizer.minimize(cost)
 
+    if args.accumulate_samples > 0:
+        #### gradient accumulation: micro-batches add the gradient of their summed token NLL, one update ####
+        #### applies it divided by the number of accumulated tokens, plus the L2 gradient once ####
+        accum_grads = [tf.Variable(tf.zeros(vv.shape.as_list()), trainable=False, name='grad_accum') for vv in vs]
+        accum_tokens = tf.Variable(0., trainable=False, name='grad_accum_tokens')
+        batch_tokens = tf.reduce_sum(y_mask)
+        token_cost = data_cost * tf.cast(tf.shape(y_mask)[1], tf.float32)   # get_cost averages over the batch
+        with tf.control_dependencies(update_ops):
+            micro_grads = optimizer.compute_gradients(token_cost, var_list=vs)
+        accumulate = tf.group(accum_tokens.assign_add(batch_tokens),
+            *[acc.assign_add(tf.convert_to_tensor(gg)) for acc, (gg, vv) in zip(accum_grads, micro_grads) if gg is not None])
+        l2_grads = tf.gradients(l2_cost, vs)
+        apply_grads = []
+        for acc, l2_g, vv in zip(accum_grads, l2_grads, vs):
+            gg = acc / tf.maximum(accum_tokens, 1.)
+            apply_grads.append((gg if l2_g is None else gg + l2_g, vv))
+        apply_accum = optimizer.apply_gradients(apply_grads)
+        with tf.control_dependencies([apply_accum]):
+            apply_accum = tf.group(accum_tokens.assign(0.), *[acc.assign(tf.zeros_like(acc)) for acc in accum_grads])
+
+    # high-water mark of the allocator of the device the step runs on
+    peak_memory = tf.contrib.memory_stats.MaxBytesInUse()
+
     max_epoch = 200
 
-    config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=True)
+    config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=args.log_device_placement)
 
     config.gpu_options.allow_growth=True
 
@@ -626,8 +1120,9 @@ def main(args):
 
     uidx = 0
     cost_s = 0
-    dispFreq = 1
-    saveFreq = len(train)
+    dispFreq = args.disp_freq
+    metricsFreq = args.metrics_freq or dispFreq
+    saveFreq = args.save_freq or len(train)
     sampleFreq = len(train)
     validFreq = len(train)
     history_errs = []
@@ -635,22 +1130,276 @@ def main(args):
     halfLrFlag = 0
     patience = 15
     lrate = 1.0
-    log = open(args.path + '/log-bs-6.txt', 'w')
+    bad_counter = 0
+    accum_samples = 0
+    log = open(args.path + '/log-bs-6.txt', 'a' if args.resume else 'w')
+    # JSON lines: 'train' records every metricsFreq updates, one 'valid' record per validation pass
+    metrics = PhaseTimer(args.metrics_file or args.path + '/metrics-bs-6.jsonl', append=bool(args.resume))
+    cost_m = 0.
+    trace_steps = set(args.trace_steps)
+
+    checkpoint_writer = CheckpointWriter()
+    train_order = list(range(len(train)))
+
+    decode_pool = None
+    if args.decode_workers > 0:
+        decode_pool = DecodePool(args.decode_workers, mode=args.decode_mode, threads=args.decode_threads,
+            memory_efficient=args.memory_efficient, attention_window=args.attention_window,
+            attention_fallback=args.attention_fallback)
+
+    # in-process decoding shares one encoder pass with the cost (sampleFreq == validFreq)
+    valid_costs = None
+
+    # per-image encoder outputs, keyed by image content and uidx (the weights only change with an update);
+    # the in-process validation pass fills it and --compare_decoders / --beam_sweep decode from it without
+    # running the DenseNet again (with --decode_workers the images are encoded in the workers instead)
+    beam_widths = [int(kk) for kk in args.beam_sweep.split(',') if kk]
+    annotation_cache = None
+    if args.annotation_cache_mb > 0 and (args.compare_decoders or beam_widths):
+        annotation_cache = AnnotationCache(args.annotation_cache_mb * 2**20, spill_dir=args.annotation_spill or None,
+            max_spill_bytes=args.annotation_spill_mb * 2**20)
+
+    def encode_image(xx):
+        #### annotation and watch vector of one unpadded [1, H, W] image, with a batch axis of 1 ####
+        if annotation_cache is not None:
+            cached = annotation_cache.get(xx, uidx)
+            if cached is not None:
+                return cached[0][None], cached[1][None]
+        xx_pad = (np.moveaxis(xx, 0, -1) / np.float32(255.))[None, :, :, :]
+        annot, annot_w = sess.run([annotation, annotation_watch], feed_dict={x:xx_pad, if_trainning:False})
+        if annotation_cache is not None:
+            annotation_cache.put(xx, uidx, (annot[0], annot_w[0]))
+        return annot, annot_w
+
+    def cache_batch(batch_x, annot, annot_m, annot_w):
+        #### unpadded per-image slices of a batched encoder run ####
+        for ii, xx in enumerate(batch_x):
+            rows = int(annot_m[ii, :, 0].sum())
+            cols = int(annot_m[ii, 0, :].sum())
+            # copies: a view would keep the whole padded batch alive behind the bytes the cache counts
+            annotation_cache.put(xx, uidx, (np.ascontiguousarray(annot[ii, :rows, :cols]),
+                np.ascontiguousarray(annot_w[ii, :rows, :cols])))
+
+    def decode_batch(batch_x, batch_y, mode):
+        #### best token sequence of every image of a validation batch with one of the decoders ####
+        if mode == 'greedy':
+            xx, xx_m, _, _ = prepare_data(batch_x, batch_y, buffers=valid_buffers)
+            decoded = list(sess.run(greedy_sample, feed_dict={x:xx, x_mask:xx_m, if_trainning:False}))
+        elif mode == 'graph':
+            decoded = []
+            for xx in batch_x:
+                annot, _ = encode_image(xx)
+                decoded.append(sess.run(graph_sample, feed_dict={anno:annot, if_trainning:False}))
+        elif mode == 'resident':
+            decoded = []
+            for xx in batch_x:
+                xx_pad = (np.moveaxis(xx, 0, -1) / np.float32(255.))[None, :, :, :]
+                sample, score = wap.get_sample_resident(res_load, beam_parent, beam_y, res_p, if_trainning,
+                    {x:xx_pad, if_trainning:False}, 10, 100, sess, training=False)
+                score = np.array(score) / np.array([len(s) for s in sample])
+                decoded.append(sample[score.argmin()])
+        elif mode == 'batch':
+            xx, xx_m, _, _ = prepare_data(batch_x, batch_y, buffers=valid_buffers)
+            annot, annot_m, annot_w = sess.run([annotation, anno_mask, annotation_watch], feed_dict={x:xx, x_mask:xx_m, if_trainning:False})
+            h_state = sess.run(hidden_state_0_m, feed_dict={anno:annot, anno_m:annot_m})
+            samples, scores = WAP.get_sample_batch(anno, anno_m, infer_y, h_pre, alpha_past, if_trainning, p_m, h_m, alpha_m,
+                annot, annot_m, h_state, 10, 100, sess, training=False, watch=watch, watch0=annot_w)
+            decoded = []
+            for sample, score in zip(samples, scores):
+                score = np.array(score) / np.array([len(s) for s in sample])
+                decoded.append(sample[score.argmin()])
+        else:
+            # 'host' beam search with get_sample; 'dense' runs it over the full attention map next to --attention_window
+            step = (p_dense, w_dense, h_dense, alpha_dense) if mode == 'dense' else (p, w, h, alpha)
+            decoded = []
+            for xx in batch_x:
+                annot, annot_w = encode_image(xx)
+                h_state = sess.run(hidden_state_0, feed_dict={anno:annot})
+                sample, score = wap.get_sample(anno, infer_y, h_pre, alpha_past, if_trainning, *step, annot, h_state,
+                 10, 100, False, sess, training=False, watch=watch, watch0=annot_w)
+                score = score / np.array([len(s) for s in sample])
+                decoded.append(sample[score.argmin()])
+        return decoded
+
+    def fused_validation(valid_costs):
+        #### one encoder run per validation batch fetches the teacher-forced cost, annotation, mask, watch ####
+        #### vector and h_0 together; every image is then decoded from its unpadded slice of that batch ####
+        for batch_x, batch_y in valid:
+            xx, xx_m, yy, yy_m = prepare_data(batch_x, batch_y, buffers=valid_buffers)
+            fetches = [cost, annotation, anno_mask, annotation_watch, annotation_h0]
+            if args.decode_mode == 'greedy':
+                fetches.append(greedy_sample)
+            outputs = sess.run(fetches, feed_dict={x:xx, x_mask:xx_m, y:yy, y_mask:yy_m, if_trainning:False})
+            batch_cost, annot, annot_m, annot_w, h_state = outputs[:5]
+            valid_costs.append(batch_cost)
+            if annotation_cache is not None:
+                cache_batch(batch_x, annot, annot_m, annot_w)
+            if args.decode_mode == 'greedy':
+                for ss in outputs[5]:
+                    yield ss
+                continue
+            if args.batch_decode:
+                samples, scores = WAP.get_sample_batch(anno, anno_m, infer_y, h_pre, alpha_past, if_trainning, p_m, h_m, alpha_m,
+                    annot, annot_m, h_state, 10, 100, sess, training=False, watch=watch, watch0=annot_w)
+                for sample, score in zip(samples, scores):
+                    score = np.array(score) / np.array([len(s) for s in sample])
+                    yield sample[score.argmin()]
+                continue
+            for ii in range(len(batch_x)):
+                rows = int(annot_m[ii, :, 0].sum())
+                cols = int(annot_m[ii, 0, :].sum())
+                annot_i = annot[ii:ii+1, :rows, :cols]
+                if args.graph_decode:
+                    yield sess.run(graph_sample, feed_dict={anno:annot_i, if_trainning:False})
+                    continue
+                if args.resident_decode:
+                    # the load op reads the fed annotation instead of running the encoder
+                    sample, score = wap.get_sample_resident(res_load, beam_parent, beam_y, res_p, if_trainning,
+                        {annotation:annot_i, if_trainning:False}, 10, 100, sess, training=False)
+                    score = np.array(score) / np.array([len(s) for s in sample])
+                else:
+                    sample, score = wap.get_sample(anno, infer_y, h_pre, alpha_past, if_trainning, p, w, h, alpha, annot_i, h_state[ii:ii+1],
+                        10, 100, False, sess, training=False, watch=watch, watch0=annot_w[ii:ii+1, :rows, :cols])
+                    score = score / np.array([len(s) for s in sample])
+                yield sample[score.argmin()]
+
+    def compare_decoders():
+        #### ExpRate and throughput of every decoder on the validation set, and how often each one returns ####
+        #### the same sequence as host beam search (get_sample), the reference the other decoders reproduce ####
+        reference = None
+        for mode in ['host', 'batch', 'graph', 'resident', 'greedy'] + (['dense'] if args.attention_window > 0 else []):
+            decoded = []
+            correct = 0
+            start = time.time()
+            for batch_x, batch_y in valid:
+                for ss, label in zip(decode_batch(batch_x, batch_y, mode), batch_y):
+                    ss = [int(vv) for vv in ss]
+                    if 0 in ss:
+                        ss = ss[:ss.index(0)] # <eol>
+                    correct += ss == list(label)
+                    decoded.append(ss)
+            elapsed = time.time() - start
+            if reference is None:
+                reference = decoded
+            agree = sum(ss == rr for ss, rr in zip(decoded, reference))
+            msg = 'Decode %s ExpRate: %.2f%%, %.1f images/s, same as host beam: %.2f%%' % (mode, 100. * correct / len(decoded),
+                len(decoded) / elapsed, 100. * agree / len(decoded))
+            print(msg)
+            log.write(msg + '\n')
+            log.flush()
+
+    def beam_sweep():
+        #### ExpRate and throughput of host beam search at every width of --beam_sweep ####
+        for kk in beam_widths:
+            correct = 0
+            total = 0
+            start = time.time()
+            for batch_x, batch_y in valid:
+                for xx, label in zip(batch_x, batch_y):
+                    annot, annot_w = encode_image(xx)
+                    h_state = sess.run(hidden_state_0, feed_dict={anno:annot})
+                    sample, score = wap.get_sample(anno, infer_y, h_pre, alpha_past, if_trainning, p, w, h, alpha, annot, h_state,
+                        kk, 100, False, sess, training=False, watch=watch, watch0=annot_w)
+                    score = score / np.array([len(s) for s in sample])
+                    ss = [int(vv) for vv in sample[score.argmin()]]
+                    if 0 in ss:
+                        ss = ss[:ss.index(0)] # <eol>
+                    correct += ss == list(label)
+                    total += 1
+            elapsed = time.time() - start
+            msg = 'Beam width %d ExpRate: %.2f%%, %.1f images/s' % (kk, 100. * correct / total, total / elapsed)
+            print(msg)
+            log.write(msg + '\n')
+            log.flush()
 
     with tf.Session(config=config) as sess:
         sess.run(init)
-        for epoch in range(max_epoch):
+        start_epoch = 0
+        resume_state = None
+        if args.resume:
+            weights, resume_state = read_checkpoint(args.resume)
+            # a checkpoint of a differently built graph (--accumulate_samples, --mixed_precision) would leave
+            # freshly initialized variables behind
+            missing = restore(sess, weights)
+            if missing:
+                raise ValueError('checkpoint lacks %s' % ', '.join(missing))
+            uidx = resume_state['uidx']
+            lrate = resume_state['lrate']
+            halfLrFlag = resume_state['halfLrFlag']
+            bad_counter = resume_state['bad_counter']
+            history_errs = resume_state['history_errs']
+            start_epoch = resume_state['epoch']
+            np.random.set_state(resume_state['numpy_random'])
+            accum_samples = resume_state.get('accum_samples', 0)     # the partial gradient sums are restored with the weights
+            print('Resumed from', args.resume, 'at epoch', start_epoch, 'update', uidx)
+
+        def train_state(epoch, epoch_done, epoch_state):
+            return {'epoch': epoch, 'epoch_done': epoch_done, 'epoch_state': epoch_state, 'uidx': uidx,
+                'lrate': lrate, 'halfLrFlag': halfLrFlag, 'bad_counter': bad_counter,
+                'history_errs': list(history_errs), 'numpy_random': np.random.get_state(), 'accum_samples': accum_samples}
+
+        for epoch in range(start_epoch, max_epoch):
             n_samples = 0
-            random.shuffle(train)
-            for batch_x, batch_y in train:
-                batch_x, batch_x_m, batch_y, batch_y_m = prepare_data(batch_x, batch_y)
+            epoch_done = 0
+            #### everything the batch order of this epoch depends on, so a resume replays it exactly ####
+            if resume_state is not None:
+                epoch_state = resume_state['epoch_state']
+                epoch_done = resume_state['epoch_done']
+                random.setstate(epoch_state['random'])
+                if args.bucketing:
+                    train.restore(epoch_state['sampler'])
+                else:
+                    train_order = list(epoch_state['order'])
+                resume_state = None
+            if args.bucketing:
+                epoch_random = random.getstate()
+                epoch_batches = list(train)     # the bucket sampler reshuffles itself on every pass
+                epoch_state = {'random': epoch_random, 'sampler': train.build_state}
+            else:
+                epoch_state = {'random': random.getstate(), 'order': list(train_order)}
+                random.shuffle(train_order)
+                epoch_batches = [train[i] for i in train_order]
+            epoch_batches = epoch_batches[epoch_done:]
+            if args.prefetch > 0:
+                train_batches = prefetcher(epoch_batches)
+            else:
+                train_batches = (prepare_data(batch_x, batch_y, buffers=train_buffers) for batch_x, batch_y in epoch_batches)
+            batch_wait = time.time()
+            for batch_x, batch_x_m, batch_y, batch_y_m in train_batches:
+                # time spent waiting for this batch: prepare_data, or the prefetch queue when it runs dry
+                metrics.add('batch_prep', time.time() - batch_wait)
                 n_samples += len(batch_x)
                 uidx += 1
-
-                cost_i, _ = sess.run([cost, trainer],
-                    feed_dict={x:batch_x, y:batch_y, x_mask:batch_x_m, y_mask:batch_y_m, if_trainning:True, lr:lrate})
-
+                epoch_done += 1
+
+                run_kwargs = {}
+                if uidx in trace_steps:
+                    run_kwargs = {'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), 'run_metadata': tf.RunMetadata()}
+
+                with metrics.timed('sess_run'):
+                    if args.accumulate_samples > 0:
+                        cost_i, _, peak_i = sess.run([cost, accumulate, peak_memory],
+                            feed_dict={x:batch_x, y:batch_y, x_mask:batch_x_m, y_mask:batch_y_m, if_trainning:True}, **run_kwargs)
+                        accum_samples += len(batch_x)
+                        # large-image buckets contribute several micro-batches to one update
+                        if accum_samples >= args.accumulate_samples:
+                            sess.run(apply_accum, feed_dict={lr:lrate})
+                            accum_samples = 0
+                    else:
+                        cost_i, _, peak_i = sess.run([cost, trainer, peak_memory],
+                            feed_dict={x:batch_x, y:batch_y, x_mask:batch_x_m, y_mask:batch_y_m, if_trainning:True, lr:lrate}, **run_kwargs)
+
+                if run_kwargs:
+                    # open in chrome://tracing
+                    trace = timeline.Timeline(run_kwargs['run_metadata'].step_stats)
+                    if not os.path.isdir(args.path + '/trace'):
+                        os.makedirs(args.path + '/trace')
+                    with open(args.path + '/trace/step-%d.json' % uidx, 'w') as fp:
+                        fp.write(trace.generate_chrome_trace_format())
+
+                metrics.count(steps=1, samples=len(batch_x), pixels=int(batch_x_m.sum()), padded_pixels=int(batch_x_m.size))
                 cost_s += cost_i
+                cost_m += cost_i
 
                 if np.isnan(cost_i) or np.isinf(cost_i):
                     print('invalid cost value detected')
@@ -659,65 +1408,94 @@ def main(args):
 
                 if np.mod(uidx, dispFreq) == 0:
                     cost_s /= dispFreq
-                    print('Epoch ', epoch, 'Update ', uidx, 'Cost ', cost_s, 'Lr ', lrate)
-                    log.write('Epoch ' + str(epoch) + ' Update ' + str(uidx) + ' Cost ' + str(cost_s) + ' Lr ' + str(lrate) + '\n')
+                    print('Epoch ', epoch, 'Update ', uidx, 'Cost ', cost_s, 'Lr ', lrate, 'Peak MB ', peak_i / 2**20)
+                    log.write('Epoch ' + str(epoch) + ' Update ' + str(uidx) + ' Cost ' + str(cost_s) + ' Lr ' + str(lrate)
+                        + ' Peak MB ' + str(peak_i / 2**20) + '\n')
                     log.flush()
                     cost_s = 0
 
+                if np.mod(uidx, metricsFreq) == 0:
+                    metrics.emit('train', epoch=epoch, uidx=uidx, cost=cost_m / metrics.counters['steps'], lr=lrate,
+                        peak_mb=peak_i / 2**20)
+                    cost_m = 0.
 
                 if np.mod(uidx, sampleFreq) == 0:
+                    valid_start = time.time()
+                    score_time = 0.
                     fpp_sample = open(args.path + '/result/valid_decode_result-bs-6.txt', 'w')
                     valid_count_idx = 0
-                    for batch_x, batch_y in valid:
-                        for xx in batch_x:
-                            xx = np.moveaxis(xx, 0, -1)
-                            xx_pad = np.zeros((xx.shape[0], xx.shape[1], xx.shape[2]), dtype='float32')
-                            xx_pad[:,:, :] = xx / 255.
-                            xx_pad = xx_pad[None, :, :, :]
-                            annot = sess.run(annotation, feed_dict={x:xx_pad, if_trainning:False})
-                            h_state = sess.run(hidden_state_0, feed_dict={anno:annot})
-                            sample, score = wap.get_sample(anno, infer_y, h_pre, alpha_past, if_trainning, p, w, h, alpha, annot, h_state,
-                             10, 100, False, sess, training=False)
-                            score = score / np.array([len(s) for s in sample])
-                            ss = sample[score.argmin()]
-                            fpp_sample.write(valid_uid_list[valid_count_idx])
-                            valid_count_idx=valid_count_idx+1
-                            if np.mod(valid_count_idx, 10) == 0:
-                                print('gen %d samples'%valid_count_idx)
-                                log.write('gen %d samples'%valid_count_idx + '\n')
-                                log.flush()
-                            for vv in ss:
-                                if vv == 0: # <eol>
-                                    break
-                                fpp_sample.write(' '+worddicts_r[vv])
-                            fpp_sample.write('\n')
+                    valid_scorer = StreamingScorer(valid_labels)
+                    if annotation_cache is not None:
+                        annotation_cache.retain(uidx)
+                    if decode_pool is not None:
+                        # workers restore this snapshot and decode their shards of the valid set in parallel
+                        save_weights(sess, args.path + '/result/decode_weights.npz')
+                        valid_decoded = decode_pool.decode(args.path + '/result/decode_weights.npz', uidx,
+                            [xx for batch_x, batch_y in valid for xx in batch_x])
+                    else:
+                        valid_costs = []
+                        valid_decoded = fused_validation(valid_costs)
+                    for ss in valid_decoded:
+                        ss = [int(vv) for vv in ss]
+                        if 0 in ss:
+                            ss = ss[:ss.index(0)] # <eol>
+                        score_start = time.time()
+                        valid_scorer.push(valid_uid_list[valid_count_idx], ss)
+                        score_time += time.time() - score_start
+                        fpp_sample.write(valid_uid_list[valid_count_idx])
+                        valid_count_idx=valid_count_idx+1
+                        if np.mod(valid_count_idx, 10) == 0:
+                            score_start = time.time()
+                            running_wer = valid_scorer.wer
+                            score_time += time.time() - score_start
+                            print('gen %d samples, WER %.2f%%' % (valid_count_idx, 100. * running_wer))
+                            log.write('gen %d samples, WER %.2f%%' % (valid_count_idx, 100. * running_wer) + '\n')
+                            log.flush()
+                        for vv in ss:
+                            fpp_sample.write(' '+worddicts_r[vv])
+                        fpp_sample.write('\n')
                     fpp_sample.close()
+                    decode_time = time.time() - valid_start - score_time
                     print('valid set decode done')
                     log.write('valid set decode done\n')
                     log.flush()
+                    if args.compare_decoders:
+                        compare_decoders()
+                    if beam_widths:
+                        beam_sweep()
 
 
                 if np.mod(uidx, validFreq) == 0:
-                    probs = []
-                    for batch_x, batch_y in valid:
-                        batch_x, batch_x_m, batch_y, batch_y_m = prepare_data(batch_x, batch_y)
-                        pprobs, annot = sess.run([cost, annotation], feed_dict={x:batch_x, y:batch_y, x_mask:batch_x_m, y_mask:batch_y_m, if_trainning:False})
-                        probs.append(pprobs)
+                    cost_start = time.time()
+                    if valid_costs is not None:
+                        # the fused decode pass already computed the cost of every batch
+                        probs = valid_costs
+                        valid_costs = None
+                    else:
+                        probs = []
+                        for batch_x, batch_y in valid:
+                            xx, xx_m, yy, yy_m = prepare_data(batch_x, batch_y, buffers=valid_buffers)
+                            pprobs = sess.run(cost, feed_dict={x:xx, y:yy, x_mask:xx_m, y_mask:yy_m, if_trainning:False})
+                            probs.append(pprobs)
+                    if annotation_cache is not None:
+                        print(annotation_cache.stats())
+                        log.write(annotation_cache.stats() + '\n')
                     valid_errs = np.array(probs)
                     valid_err_cost = valid_errs.mean()
-                    print("reached here")
-#                     os.system('python2 compute-wer.py ' + args.path + '/result/valid_decode_result-bs-6.txt' + ' ' + args.path + '/data/test_caption.txt' + ' ' + args.path + '/result/valid-bs-6.wer')
-                    process(args.path + '/result/valid_decode_result-bs-6.txt', args.path + '/data/test_caption.txt', args.path + '/result/valid-bs-6.wer')
-                    fpp=open(args.path + '/result/valid-bs-6.wer')
-                    stuff=fpp.readlines()
-                    fpp.close()
-                    m=re.search('WER (.*)\n',stuff[0])
-                    valid_per=100. * float(m.group(1))
-                    m=re.search('ExpRate (.*)\n',stuff[1])
-                    valid_sacc=100. * float(m.group(1))
+                    cost_time = time.time() - cost_start
+                    # the decode pass already scored every hypothesis as it finished
+                    score_start = time.time()
+                    valid_scorer.write(args.path + '/result/valid-bs-6.wer')
+                    valid_per=100. * valid_scorer.wer
+                    valid_sacc=100. * valid_scorer.exprate
+                    score_time += time.time() - score_start
                     valid_err=valid_per
+                    metrics.write({'kind': 'valid', 'time': time.time(), 'epoch': epoch, 'uidx': uidx,
+                        'decode_s': decode_time, 'score_s': score_time, 'cost_s': cost_time, 'samples': valid_count_idx,
+                        'wer': valid_per, 'exprate': valid_sacc, 'cost': float(valid_err_cost)})
 
                     history_errs.append(valid_err)
+                    is_best = valid_err <= np.array(history_errs).min()
 
                     if uidx/validFreq == 0 or valid_err <= np.array(history_errs).min():
                         bad_counter = 0
@@ -739,17 +1517,72 @@ def main(args):
                                 lrate = lrate / 10
                                 halfLrFlag += 1
 
+                    if is_best:
+                        # after the early stopping update, so a resume from it continues with the same counters
+                        checkpoint_writer.save(args.path + '/models/wap-best.pkl', snapshot(sess),
+                            train_state(epoch, epoch_done, epoch_state))
+
                     print('Valid WER: %.2f%%, ExpRate: %.2f%%, Cost: %f' % (valid_per,valid_sacc,valid_err_cost))
                     log.write('Valid WER: %.2f%%, ExpRate: %.2f%%, Cost: %f' % (valid_per,valid_sacc,valid_err_cost) + '\n')
                     log.flush()
+
+                if np.mod(uidx, saveFreq) == 0:
+                    # only the variable fetch blocks the step loop, the write happens in the background
+                    checkpoint_writer.save(args.path + '/models/wap.pkl', snapshot(sess),
+                        train_state(epoch, epoch_done, epoch_state))
+                batch_wait = time.time()
+            epoch_padding = train.padding_ratio if args.bucketing else padding_ratio(train)
+            print('Epoch ', epoch, 'padded pixels %.2f%%' % (100. * epoch_padding))
+            log.write('Epoch ' + str(epoch) + ' padded pixels %.2f%%' % (100. * epoch_padding) + '\n')
+            if args.prefetch > 0:
+                print(prefetcher.report())
+                log.write(prefetcher.report() + '\n')
+                log.flush()
+                prefetcher.reset_stats()
             if estop:
                 break
 
+    checkpoint_writer.close()
+    metrics.close()
+    if decode_pool is not None:
+        decode_pool.close()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--path", default=".")
     parser.add_argument("--batch_size", type=int, default=6)
+    parser.add_argument("--prefetch", type=int, default=0)  # depth of the background batch queue, 0 disables it
+    parser.add_argument("--bucketing", action="store_true")  # (H, W) bucket sampler with a real padded-pixel budget
+    parser.add_argument("--batch_decode", action="store_true")  # beam search over whole validation batches
+    parser.add_argument("--graph_decode", action="store_true")  # in-graph tf.while_loop beam search, one run per image
+    parser.add_argument("--resident_decode", action="store_true")  # annotation and beam states stay in graph variables
+    parser.add_argument("--decode_mode", default="beam", choices=["beam", "greedy"])
+    parser.add_argument("--compare_decoders", action="store_true")  # ExpRate, throughput and agreement with host beam search of every decoder
+    parser.add_argument("--beam_sweep", default="")  # comma separated beam widths re-decoded after every validation, e.g. 1,5,10
+    parser.add_argument("--decode_workers", type=int, default=0)  # CPU processes for validation decoding, 0 decodes in-process
+    parser.add_argument("--decode_threads", type=int, default=1)  # intra-op threads of every decode worker
+    parser.add_argument("--save_freq", type=int, default=0)  # updates between checkpoints, 0 saves once per epoch
+    parser.add_argument("--resume", default="")  # checkpoint written to <path>/models to continue from
+    parser.add_argument("--train_shards", default="")
+    parser.add_argument("--valid_shards", default="")
+    parser.add_argument("--memory_efficient", action="store_true")  # recompute DenseNet concat/bottleneck in backprop
+    parser.add_argument("--batch_Imagesize", type=int, default=400000)  # padded pixels per batch
+    parser.add_argument("--maxImagesize", type=int, default=400000)  # larger images are dropped from the data set
+    parser.add_argument("--mixed_precision", action="store_true")  # float16 compute with dynamic loss scaling
+    parser.add_argument("--accumulate_samples", type=int, default=0)  # samples per optimizer update, 0 updates every batch
+    parser.add_argument("--annotation_cache_mb", type=int, default=0)  # encoder outputs of the valid set reused by --compare_decoders / --beam_sweep, 0 disables it
+    parser.add_argument("--annotation_spill", default="")  # directory for cache entries evicted from memory
+    parser.add_argument("--annotation_spill_mb", type=int, default=0)  # size limit of the spill directory, 0 is unlimited
+    parser.add_argument("--crop", action="store_true")  # tight crop every image to its ink bounding box (.pkl inputs; shards are cropped by compile-shards.py)
+    parser.add_argument("--max_pixels", type=int, default=0)  # downscale larger images instead of dropping them, 0 disables
+    parser.add_argument("--disp_freq", type=int, default=1)  # updates between cost lines in the log
+    parser.add_argument("--metrics_freq", type=int, default=0)  # updates between 'train' metric records, 0 follows --disp_freq
+    parser.add_argument("--metrics_file", default="")  # JSON lines, default <path>/metrics-bs-6.jsonl
+    parser.add_argument("--trace_steps", type=int, nargs="*", default=[])  # updates to capture as Chrome timeline traces
+    parser.add_argument("--log_device_placement", action="store_true")
+    parser.add_argument("--attention_window", type=int, default=0)  # annotation columns scored per decoding step, 0 is dense
+    parser.add_argument("--attention_fallback", type=float, default=0.2)  # window edge weight that falls back to the full map
     (args, unknown) = parser.parse_known_args()
     device_name = "/gpu:0"
     with tf.device(device_name):
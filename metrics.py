@@ -0,0 +1,71 @@
+import os
+import json
+import time
+
+# Structured training metrics. Phases accumulate wall time and counters accumulate
+# totals between two emits; every emit appends one JSON object per line to the
+# metrics file, so a run can be followed with `tail -f` or loaded with pandas.
+# Rates are per second of timed phases, so validation passes and checkpoints that
+# fall between two emits do not count against the training throughput.
+
+class PhaseTimer():
+    def __init__(self, path, append=False):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.fp = open(path, 'a' if append else 'w')
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.counters = {}
+        self.start = time.time()
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.) + seconds
+
+    def count(self, **counters):
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def timed(self, phase):
+        return _Phase(self, phase)
+
+    def emit(self, kind, **fields):
+        #### one record with the phase times (seconds), counters and rates since the last emit ####
+        elapsed = time.time() - self.start
+        busy = sum(self.phases.values()) if self.phases else elapsed
+        record = {'kind': kind, 'time': time.time(), 'elapsed_s': elapsed}
+        for phase, seconds in self.phases.items():
+            record[phase + '_s'] = seconds
+        record.update(self.counters)
+        for key in ['samples', 'pixels']:
+            if key in self.counters:
+                record[key + '_per_s'] = self.counters[key] / max(busy, 1e-9)
+        if 'pixels' in self.counters and 'padded_pixels' in self.counters:
+            record['padding_ratio'] = 1. - float(self.counters['pixels']) / max(self.counters['padded_pixels'], 1)
+        record.update(fields)
+        self.write(record)
+        self.reset()
+        return record
+
+    def write(self, record):
+        #### records timed elsewhere (validation passes) go through without touching the accumulators ####
+        self.fp.write(json.dumps(record) + '\n')
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+
+class _Phase():
+    def __init__(self, timer, phase):
+        self.timer = timer
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.add(self.phase, time.time() - self.start)
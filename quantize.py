@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import argparse
+import pickle as pkl
+import numpy as np
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+from data import load_shards, load_targets, load_dict, prepare_data, preprocess_features
+from export import load_frozen
+from main import WAP
+from wer import StreamingScorer
+
+# Post-training int8 quantization of the frozen graphs written by export.py.
+#   weights: int8 weight constants, dequantized at load, float32 arithmetic
+#   full:    int8 weights and activations for Conv2D / MatMul / BiasAdd / Relu / pooling;
+#            requantization ranges are calibrated on a sample of the training set
+# The float32 and int8 graphs are then decoded on the test set image by image on CPU
+# and ExpRate, WER, latency and graph size are reported side by side.
+
+GRAPHS = ['encoder.pb', 'decoder_step.pb']
+PRINT_SUFFIX = '__print__'
+REQUANT_PREFIX = '__requant_min_max:'
+
+def load_features(feature_file, crop=False, max_pixels=0):
+    if os.path.isdir(feature_file):
+        # compiled shards were preprocessed by compile-shards.py
+        features, _ = load_shards(feature_file)
+        return features
+    fp = open(feature_file, 'rb')
+    features = pkl.load(fp)
+    fp.close()
+    if crop or max_pixels > 0:
+        features, _ = preprocess_features(features, max_pixels, crop)
+    return features
+
+def read_graph_def(path):
+    graph_def = tf.GraphDef()
+    with open(path, 'rb') as fp:
+        graph_def.ParseFromString(fp.read())
+    return graph_def
+
+def write_graph_def(graph_def, path):
+    with open(path, 'wb') as fp:
+        fp.write(graph_def.SerializeToString())
+
+def quantize_graph(graph_def, inputs, outputs, mode):
+    transforms = ['add_default_attributes', 'fold_constants(ignore_errors=true)', 'quantize_weights']
+    if mode == 'full':
+        transforms.append('quantize_nodes')
+    transforms += ['strip_unused_nodes', 'sort_by_execution_order']
+    return TransformGraph(graph_def, [n.split(':')[0] for n in inputs], [n.split(':')[0] for n in outputs], transforms)
+
+
+class FrozenModel():
+    #### encoder + decoder step graphs in one CPU session, decoded with WAP.get_sample_batch ####
+    def __init__(self, model_dir, signature, threads=1):
+        self.graph = tf.Graph()
+        for filename in GRAPHS:
+            load_frozen(os.path.join(model_dir, filename), self.graph, name=filename.split('.')[0])
+        t = dict((filename, ([self.tensor(filename, n) for n in spec['inputs']], [self.tensor(filename, n) for n in spec['outputs']]))
+            for filename, spec in signature.items())
+        (self.x, self.x_mask), (self.annotation, self.anno_mask, self.watch0, self.h_0) = t['encoder.pb']
+        (self.anno, self.anno_m, self.watch, self.infer_y, self.h_pre, self.alpha_past), (self.p, self.h, self.alpha) = t['decoder_step.pb']
+        config = tf.ConfigProto(device_count={'GPU': 0}, intra_op_parallelism_threads=threads,
+            inter_op_parallelism_threads=1)
+        self.sess = tf.Session(graph=self.graph, config=config)
+
+    def tensor(self, filename, name):
+        return self.graph.get_tensor_by_name(filename.split('.')[0] + '/' + name)
+
+    def requant_ranges(self):
+        return [op for op in self.graph.get_operations() if op.type == 'RequantizationRange']
+
+    def decode(self, images, k=10, maxlen=100, session=None):
+        session = session or self.sess
+        xx, xx_m, _, _ = prepare_data(images, [[]] * len(images))
+        annot, annot_m, annot_w, h_state = session.run([self.annotation, self.anno_mask, self.watch0, self.h_0],
+            feed_dict={self.x:xx, self.x_mask:xx_m})
+        samples, scores = WAP.get_sample_batch(self.anno, self.anno_m, self.infer_y, self.h_pre, self.alpha_past,
+            None, self.p, self.h, self.alpha, annot, annot_m, h_state, k, maxlen, session, training=False,
+            watch=self.watch, watch0=annot_w)
+        decoded = []
+        for sample, score in zip(samples, scores):
+            score = np.array(score) / np.array([len(s) for s in sample])
+            decoded.append(sample[score.argmin()])
+        return decoded
+
+
+class RangeRecorder():
+    # Stands in for the session during calibration: every run also fetches the
+    # dynamic requantization ranges and keeps their running min / max.
+    def __init__(self, model):
+        self.sess = model.sess
+        self.ops = model.requant_ranges()
+        self.low = dict((op.name, np.inf) for op in self.ops)
+        self.high = dict((op.name, -np.inf) for op in self.ops)
+
+    def run(self, fetches, feed_dict=None):
+        # only ranges computed from the fed inputs can be evaluated in this call
+        inputs = set(t.op.name for t in feed_dict)
+        ops = [op for op in self.ops if self.reachable(op, inputs)]
+        values = self.sess.run([fetches, [(op.outputs[0], op.outputs[1]) for op in ops]], feed_dict=feed_dict)
+        for op, (low, high) in zip(ops, values[1]):
+            self.low[op.name] = min(self.low[op.name], float(low))
+            self.high[op.name] = max(self.high[op.name], float(high))
+        return values[0]
+
+    def reachable(self, op, inputs):
+        # both graphs are imported under their own scope, the feeds name the scope in use
+        return any(op.name.split('/')[0] == name.split('/')[0] for name in inputs)
+
+    def write(self, log_file):
+        #### lines in the layout freeze_requantization_ranges parses from insert_logging output ####
+        with open(log_file, 'w') as fp:
+            for op in self.ops:
+                if self.low[op.name] <= self.high[op.name]:
+                    # node names inside the .pb files carry no import scope
+                    name = op.name.split('/', 1)[1]
+                    fp.write(';%s%s;%s[%f][%f]\n' % (name, PRINT_SUFFIX, REQUANT_PREFIX, self.low[op.name], self.high[op.name]))
+
+
+def calibrate(model_dir, signature, images, k, maxlen, log_file):
+    model = FrozenModel(model_dir, signature)
+    recorder = RangeRecorder(model)
+    print('calibrating', len(recorder.ops), 'requantization ranges on', len(images), 'images')
+    for fea in images:
+        model.decode([fea], k, maxlen, session=recorder)
+    recorder.write(log_file)
+
+def quantize(float_dir, out_dir, mode, calib_images, k, maxlen):
+    with open(os.path.join(float_dir, 'signature.json')) as fp:
+        signature = json.load(fp)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    graphs = {}
+    for filename in GRAPHS:
+        spec = signature[filename]
+        graphs[filename] = quantize_graph(read_graph_def(os.path.join(float_dir, filename)), spec['inputs'], spec['outputs'], mode)
+        write_graph_def(graphs[filename], os.path.join(out_dir, filename))
+    with open(os.path.join(out_dir, 'signature.json'), 'w') as fp:
+        json.dump(signature, fp, indent=2)
+
+    if mode == 'full':
+        # ranges left dynamic cost a RequantizationRange reduction per op at run time
+        log_file = os.path.join(out_dir, 'requant_ranges.txt')
+        calibrate(out_dir, signature, calib_images, k, maxlen, log_file)
+        for filename in GRAPHS:
+            spec = signature[filename]
+            graph_def = TransformGraph(graphs[filename], [n.split(':')[0] for n in spec['inputs']],
+                [n.split(':')[0] for n in spec['outputs']],
+                ['freeze_requantization_ranges(min_max_log_file="%s")' % log_file, 'strip_unused_nodes', 'sort_by_execution_order'])
+            write_graph_def(graph_def, os.path.join(out_dir, filename))
+    return signature
+
+def evaluate(model_dir, signature, features, labels, k, maxlen, threads):
+    model = FrozenModel(model_dir, signature, threads)
+    scorer = StreamingScorer(labels)
+    latency = []
+    for uid in sorted(labels):
+        t0 = time.time()
+        decoded = model.decode([features[uid]], k, maxlen)[0]
+        latency.append(time.time() - t0)
+        decoded = [int(vv) for vv in decoded]
+        if 0 in decoded:
+            decoded = decoded[:decoded.index(0)] # <eol>
+        scorer.push(uid, decoded)
+    latency = np.array(latency) * 1000.
+    return {
+        'wer': 100. * scorer.wer,
+        'exprate': 100. * scorer.exprate,
+        'latency_ms_mean': float(latency.mean()),
+        'latency_ms_p50': float(np.percentile(latency, 50)),
+        'latency_ms_p90': float(np.percentile(latency, 90)),
+        'graph_mb': sum(os.path.getsize(os.path.join(model_dir, f)) for f in GRAPHS) / 2.**20,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("float_dir")                          # output directory of export.py
+    parser.add_argument("out_dir")
+    parser.add_argument("--path", default=".")
+    parser.add_argument("--mode", type=str, default="full", choices=["weights", "full"])
+    parser.add_argument("--calib_features", type=str, default=None)   # default <path>/data/offline-train.pkl
+    parser.add_argument("--calib_size", type=int, default=200)
+    parser.add_argument("--test_features", type=str, default=None)   # default <path>/data/offline-test.pkl
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--crop", action="store_true")        # preprocessing the model was trained with
+    parser.add_argument("--max_pixels", type=int, default=0)
+    parser.add_argument("--report", type=str, default=None)   # JSON file for the float32 / int8 comparison
+    args = parser.parse_args()
+    k, maxlen = 10, 100
+
+    calib = load_features(args.calib_features or args.path + '/data/offline-train.pkl', args.crop, args.max_pixels)
+    rng = np.random.RandomState(1234)
+    calib_uids = sorted(calib)
+    calib_images = [calib[calib_uids[i]] for i in rng.permutation(len(calib_uids))[:args.calib_size]]
+    signature = quantize(args.float_dir, args.out_dir, args.mode, calib_images, k, maxlen)
+    del calib, calib_images
+
+    worddicts = load_dict(args.path + '/data/dictionary.txt')
+    features = load_features(args.test_features or args.path + '/data/offline-test.pkl', args.crop, args.max_pixels)
+    labels = load_targets(args.path + '/data/test_caption.txt', worddicts)
+    labels = dict((uid, lab) for uid, lab in labels.items() if uid in features)
+
+    report = {
+        'float32': evaluate(args.float_dir, signature, features, labels, k, maxlen, args.threads),
+        'int8-' + args.mode: evaluate(args.out_dir, signature, features, labels, k, maxlen, args.threads),
+    }
+    base = report['float32']
+    quant = report['int8-' + args.mode]
+    report['delta'] = dict((key, quant[key] - base[key]) for key in base)
+    for name in ['float32', 'int8-' + args.mode, 'delta']:
+        r = report[name]
+        print('%-12s ExpRate %6.2f%%  WER %6.2f%%  latency mean %7.1f ms  p50 %7.1f ms  p90 %7.1f ms  graph %6.1f MB' % (
+            name, r['exprate'], r['wer'], r['latency_ms_mean'], r['latency_ms_p50'], r['latency_ms_p90'], r['graph_mb']))
+    if args.report:
+        with open(args.report, 'w') as fp:
+            json.dump(report, fp, indent=2)
@@ -0,0 +1,285 @@
+import io
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import tensorflow as tf
+from data import load_dict, prepare_data, crop_and_scale
+from checkpoint import read_checkpoint, restore
+from main import WAP, build_wap
+
+# Local recognition service. POST an image (a .npy uint8 array of [H, W] or [1, H, W]
+# with ink > 0 like the training data, or a dark-on-white PNG/JPEG when Pillow is
+# installed) to /recognize and get LaTeX tokens back; GET /metrics for queue depth and
+# latency percentiles. Requests that arrive within --max_latency_ms of each other are
+# decoded as one batch of at most --batch_pixels padded pixels.
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class Recognizer():
+    def __init__(self, checkpoint, dictionary, mode='beam', k=10, maxlen=100, device='/cpu:0',
+                 attention_window=0, attention_fallback=0.2):
+        worddicts = load_dict(dictionary)
+        self.worddicts_r = [None] * len(worddicts)
+        for kk, vv in worddicts.items():
+            self.worddicts_r[vv] = kk
+        self.mode = mode
+        self.k = k
+        self.maxlen = maxlen
+
+        with tf.device(device):
+            self.x = tf.placeholder(tf.float32, shape=[None, None, None, 1])
+            self.x_mask = tf.placeholder(tf.float32, shape=[None, None, None])
+            self.if_trainning = tf.placeholder(tf.bool, shape=())
+            self.wap, self.annotation, self.anno_mask = build_wap(self.x, self.x_mask, self.if_trainning,
+                attention_window=attention_window, attention_fallback=attention_fallback)
+            attender = self.wap.attender
+            channels = self.annotation.shape.as_list()[3]
+            if mode == 'greedy':
+                self.greedy_sample = self.wap.get_sample_greedy(self.annotation, self.anno_mask, maxlen)
+            else:
+                self.anno = tf.placeholder(tf.float32, shape=[None, None, None, channels])
+                self.anno_m = tf.placeholder(tf.float32, shape=[None, None, None])
+                self.watch = tf.placeholder(tf.float32, shape=[None, None, None, attender.dim_attend])
+                self.infer_y = tf.placeholder(tf.int64, shape=(None,))
+                self.h_pre = tf.placeholder(tf.float32, shape=[None, self.wap.hidden_dim])
+                self.alpha_past = tf.placeholder(tf.float32, shape=[None, None, None])
+                self.annotation_watch = attender.get_watch_vector(self.annotation)
+                self.h_0 = self.wap.get_h0(self.annotation, self.anno_mask)
+                self.p, _, self.h, self.alpha = self.wap.get_word(self.infer_y, self.h_pre, self.alpha_past,
+                    self.anno, self.anno_m, self.watch)
+
+        self.sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
+        self.sess.run(tf.global_variables_initializer())
+        weights, _ = read_checkpoint(checkpoint)
+        missing = restore(self.sess, weights)
+        if missing:
+            raise ValueError('checkpoint lacks %s' % ', '.join(missing))
+
+    def decode(self, images):
+        #### LaTeX token lists for a list of uint8 [1, H, W] images ####
+        xx, xx_m, _, _ = prepare_data(images, [[]] * len(images))
+        if self.mode == 'greedy':
+            decoded = self.sess.run(self.greedy_sample, feed_dict={self.x:xx, self.x_mask:xx_m, self.if_trainning:False})
+        else:
+            annot, annot_m, annot_w, h_state = self.sess.run([self.annotation, self.anno_mask, self.annotation_watch, self.h_0],
+                feed_dict={self.x:xx, self.x_mask:xx_m, self.if_trainning:False})
+            samples, scores = WAP.get_sample_batch(self.anno, self.anno_m, self.infer_y, self.h_pre, self.alpha_past,
+                self.if_trainning, self.p, self.h, self.alpha, annot, annot_m, h_state, self.k, self.maxlen, self.sess,
+                training=False, watch=self.watch, watch0=annot_w)
+            decoded = []
+            for sample, score in zip(samples, scores):
+                score = np.array(score) / np.array([len(s) for s in sample])
+                decoded.append(sample[score.argmin()])
+        results = []
+        for ss in decoded:
+            tokens = []
+            for vv in ss:
+                if vv == 0: # <eol>
+                    break
+                tokens.append(self.worddicts_r[vv])
+            results.append(tokens)
+        return results
+
+
+class Request():
+    def __init__(self, image):
+        self.image = image
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.tokens = None
+        self.error = None
+
+
+class DynamicBatcher():
+    def __init__(self, recognizer, max_batch=8, max_latency=0.02, max_pixels=400000, window=1000):
+        self.recognizer = recognizer
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.max_pixels = max_pixels    # padded pixel budget of one batch, as batch_Imagesize in training
+        self.queue = queue.Queue()
+        self.carry = None               # request that did not fit the previous batch, it starts the next one
+        self.latencies = []
+        self.window = window
+        self.batches = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, image):
+        request = Request(image)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.tokens
+
+    def _collect(self):
+        #### first request blocks, the rest are gathered until the latency budget or batch limit runs out ####
+        if self.carry is not None:
+            batch = [self.carry]
+            self.carry = None
+        else:
+            batch = [self.queue.get()]
+        deadline = batch[0].arrival + self.max_latency
+        max_h = batch[0].image.shape[1]
+        max_w = batch[0].image.shape[2]
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            h = max(max_h, request.image.shape[1])
+            w = max(max_w, request.image.shape[2])
+            if (len(batch) + 1) * h * w > self.max_pixels:
+                self.carry = request
+                break
+            batch.append(request)
+            max_h, max_w = h, w
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                results = self.recognizer.decode([r.image for r in batch])
+                for request, tokens in zip(batch, results):
+                    request.tokens = tokens
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            finished = time.time()
+            with self.lock:
+                self.batches += 1
+                self.requests += len(batch)
+                self.latencies.extend(finished - r.arrival for r in batch)
+                self.latencies = self.latencies[-self.window:]
+            for request in batch:
+                request.done.set()
+
+    def metrics(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.
+            return {
+                'queue_depth': self.queue.qsize() + (self.carry is not None),
+                'requests': self.requests,
+                'batches': self.batches,
+                'mean_batch_size': float(self.requests) / max(self.batches, 1),
+                'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            }
+
+
+def read_image(body, content_type):
+    #### uint8 [1, H, W] in the polarity of the training data: ink > 0 on a 0 background ####
+    if content_type in ('image/png', 'image/jpeg'):
+        if Image is None:
+            raise ValueError('Pillow is required to read %s, send a .npy array instead' % content_type)
+        # scans and renderings are dark ink on a white page; .npy arrays are taken as already inverted
+        image = 255 - np.asarray(Image.open(io.BytesIO(body)).convert('L'), dtype='uint8')
+    else:
+        image = np.load(io.BytesIO(body), allow_pickle=False)
+    if image.ndim == 2:
+        image = image[None, :, :]
+    if image.ndim != 3 or image.shape[0] != 1:
+        raise ValueError('expected a [H, W] or [1, H, W] image, got shape %s' % (image.shape,))
+    return image.astype('uint8')
+
+
+class Handler(BaseHTTPRequestHandler):
+    batcher = None
+    crop = False        # same preprocessing as the training data (--crop / --max_pixels of main.py)
+    max_pixels = 0
+
+    def address_string(self):
+        return str(self.client_address or 'unix')
+
+    def reply(self, code, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.reply(200, self.batcher.metrics())
+        else:
+            self.reply(404, {'error': 'unknown path'})
+
+    def do_POST(self):
+        if self.path != '/recognize':
+            self.reply(404, {'error': 'unknown path'})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            image = read_image(body, self.headers.get('Content-Type', ''))
+            if self.crop or self.max_pixels > 0:
+                image = crop_and_scale(image, self.max_pixels, self.crop)
+        except Exception as e:
+            self.reply(400, {'error': str(e)})
+            return
+        try:
+            tokens = self.batcher.submit(image)
+        except Exception as e:
+            self.reply(500, {'error': str(e)})
+            return
+        self.reply(200, {'tokens': tokens, 'latex': ' '.join(tokens)})
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoint")                   # models/wap.pkl or models/wap-best.pkl written by main.py
+    parser.add_argument("--dictionary", default="./data/dictionary.txt")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--socket", default="")         # serve on a Unix socket instead of TCP
+    parser.add_argument("--decode_mode", default="beam", choices=["beam", "greedy"])
+    parser.add_argument("--max_batch", type=int, default=8)
+    parser.add_argument("--max_latency_ms", type=float, default=20.)
+    parser.add_argument("--batch_pixels", type=int, default=400000)   # padded pixel budget of one batch
+    parser.add_argument("--device", default="/cpu:0")
+    parser.add_argument("--crop", action="store_true")
+    parser.add_argument("--max_pixels", type=int, default=0)
+    parser.add_argument("--attention_window", type=int, default=0)   # as the model was evaluated with in main.py
+    parser.add_argument("--attention_fallback", type=float, default=0.2)
+    args = parser.parse_args()
+
+    recognizer = Recognizer(args.checkpoint, args.dictionary, mode=args.decode_mode, device=args.device,
+        attention_window=args.attention_window, attention_fallback=args.attention_fallback)
+    Handler.batcher = DynamicBatcher(recognizer, max_batch=args.max_batch, max_latency=args.max_latency_ms / 1000.,
+        max_pixels=args.batch_pixels)
+    Handler.crop = args.crop
+    Handler.max_pixels = args.max_pixels
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, Handler)
+        print('serving on unix socket', args.socket)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), Handler)
+        print('serving on http://%s:%d' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,68 @@
+import os
+import pytest
+import numpy
+
+pytest.importorskip('tensorflow')
+from checkpoint import CheckpointWriter, write_checkpoint, read_checkpoint
+
+# Checkpoint files and the background writer; no TF graph is built.
+
+def weights(seed):
+    rng = numpy.random.RandomState(seed)
+    return {'conv2d/kernel:0': rng.randn(3, 3, 1, 4).astype('float32'), 'embed:0': rng.randn(5, 2).astype('float32')}
+
+def assert_same_weights(got, expected):
+    assert sorted(got) == sorted(expected)
+    for name in expected:
+        numpy.testing.assert_array_equal(got[name], expected[name])
+
+
+def test_write_and_read_checkpoint(tmpdir):
+    path = str(tmpdir.join('models', 'wap.pkl'))
+    state = {'uidx': 12, 'lrate': 0.1, 'history_errs': [40., 35.5], 'numpy_random': numpy.random.RandomState(0).get_state()}
+    write_checkpoint(path, weights(0), state)
+    got_weights, got_state = read_checkpoint(path)
+    assert_same_weights(got_weights, weights(0))
+    assert got_state['uidx'] == 12 and got_state['history_errs'] == [40., 35.5]
+    rng = numpy.random.RandomState(1)
+    rng.set_state(got_state['numpy_random'])
+    assert rng.randint(1 << 30) == numpy.random.RandomState(0).randint(1 << 30)
+
+def test_failed_write_keeps_the_previous_checkpoint(tmpdir):
+    path = str(tmpdir.join('wap.pkl'))
+    write_checkpoint(path, weights(0), {'uidx': 1})
+    with pytest.raises(Exception):
+        write_checkpoint(path, weights(1), {'uidx': 2, 'unpicklable': lambda: None})
+    got_weights, got_state = read_checkpoint(path)
+    assert_same_weights(got_weights, weights(0))
+    assert got_state == {'uidx': 1}
+
+def test_writer_keeps_the_save_order(tmpdir):
+    path = str(tmpdir.join('wap.pkl'))
+    writer = CheckpointWriter(depth=2)
+    for uidx in range(6):
+        writer.save(path, weights(uidx), {'uidx': uidx})
+    writer.close()
+    got_weights, got_state = read_checkpoint(path)
+    assert got_state == {'uidx': 5}
+    assert_same_weights(got_weights, weights(5))
+    assert not os.path.exists(path + '.tmp')
+
+def test_writer_raises_a_failed_write(tmpdir):
+    blocker = tmpdir.join('not-a-directory')
+    blocker.write('')
+    writer = CheckpointWriter(depth=1)
+    writer.save(str(blocker.join('wap.pkl')), weights(0), {})
+    # later saves neither block on the full queue nor hide the error
+    with pytest.raises(Exception):
+        for _ in range(5):
+            writer.save(str(tmpdir.join('wap.pkl')), weights(0), {})
+    writer.close()
+
+def test_writer_close_raises_a_failed_write(tmpdir):
+    blocker = tmpdir.join('not-a-directory')
+    blocker.write('')
+    writer = CheckpointWriter()
+    writer.save(str(blocker.join('wap.pkl')), weights(0), {})
+    with pytest.raises(Exception):
+        writer.close()
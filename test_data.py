@@ -0,0 +1,185 @@
+import os
+import pickle as pkl
+import numpy
+from data import compile_shards, load_shards, load_targets, dataIterator, prepare_data, BatchBuffers, BucketSampler, crop_ink, downscale
+
+# Behaviour of the data pipeline on small synthetic sets written to a temporary directory.
+
+WORDS = ['<eol>', 'a', 'b', 'c', '+', '=']
+
+def synthetic_set(n=24, seed=1234):
+    rng = numpy.random.RandomState(seed)
+    features = {}
+    captions = {}
+    for k in range(n):
+        uid = 'img%03d' % k
+        features[uid] = rng.randint(0, 256, (1, rng.randint(5, 40), rng.randint(5, 90))).astype('uint8')
+        captions[uid] = [WORDS[t] for t in rng.randint(1, len(WORDS), rng.randint(1, 12))]
+    return features, captions
+
+def write_set(tmpdir, features, captions):
+    feature_file = os.path.join(str(tmpdir), 'features.pkl')
+    label_file = os.path.join(str(tmpdir), 'caption.txt')
+    with open(feature_file, 'wb') as fp:
+        pkl.dump(features, fp)
+    with open(label_file, 'w') as fp:
+        for uid in sorted(captions):
+            fp.write(uid + '\t' + ' '.join(captions[uid]) + '\n')
+    return feature_file, label_file
+
+def dictionary():
+    return dict((w, i) for i, w in enumerate(WORDS))
+
+
+def test_shards_round_trip(tmpdir):
+    features, captions = synthetic_set()
+    feature_file, label_file = write_set(tmpdir, features, captions)
+    shard_dir = os.path.join(str(tmpdir), 'shards')
+    # a small shard size spreads the set over several files
+    compile_shards(feature_file, label_file, dictionary(), shard_dir, shard_bytes=4096)
+    assert len([f for f in os.listdir(shard_dir) if f.startswith('images-')]) > 1
+
+    loaded, targets = load_shards(shard_dir)
+    assert sorted(loaded) == sorted(features)
+    assert targets == load_targets(label_file, dictionary())
+    for uid, fea in features.items():
+        assert isinstance(loaded[uid].base, numpy.memmap)
+        assert loaded[uid].dtype == numpy.uint8
+        numpy.testing.assert_array_equal(loaded[uid], fea)
+
+def test_shards_and_pickle_give_the_same_batches(tmpdir):
+    features, captions = synthetic_set()
+    feature_file, label_file = write_set(tmpdir, features, captions)
+    shard_dir = os.path.join(str(tmpdir), 'shards')
+    compile_shards(feature_file, label_file, dictionary(), shard_dir)
+
+    from_pkl, uids_pkl = dataIterator(feature_file, label_file, dictionary(), 4, 20000, 100, 20000)
+    from_shards, uids_shards = dataIterator(shard_dir, None, dictionary(), 4, 20000, 100, 20000)
+    assert uids_pkl == uids_shards
+    assert len(from_pkl) == len(from_shards)
+    for (x_pkl, y_pkl), (x_shards, y_shards) in zip(from_pkl, from_shards):
+        assert y_pkl == y_shards
+        for a, b in zip(x_pkl, x_shards):
+            numpy.testing.assert_array_equal(a, b)
+
+
+def baseline_prepare_data(images_x, seqs_y):
+    #### prepare_data as it was before BatchBuffers ####
+    heights_x = [s.shape[1] for s in images_x]
+    widths_x = [s.shape[2] for s in images_x]
+    lengths_y = [len(s) for s in seqs_y]
+
+    n_samples = len(heights_x)
+    max_height_x = numpy.max(heights_x)
+    max_width_x = numpy.max(widths_x)
+    maxlen_y = numpy.max(lengths_y) + 1
+
+    x = numpy.zeros((n_samples, max_height_x, max_width_x, 1)).astype('float32')
+    y = numpy.zeros((maxlen_y, n_samples)).astype('int64')
+    x_mask = numpy.zeros((n_samples, max_height_x, max_width_x)).astype('float32')
+    y_mask = numpy.zeros((maxlen_y, n_samples)).astype('float32')
+    for idx, [s_x, s_y] in enumerate(zip(images_x, seqs_y)):
+        x[idx, :heights_x[idx], :widths_x[idx], :] = (numpy.moveaxis(s_x, 0, -1) / 255.)
+        x_mask[idx, :heights_x[idx], :widths_x[idx]] = 1.
+        y[:lengths_y[idx], idx] = s_y
+        y_mask[:lengths_y[idx]+1, idx] = 1.
+    return x, x_mask, y, y_mask
+
+def test_batch_buffers_match_baseline(tmpdir):
+    features, captions = synthetic_set(n=40)
+    feature_file, label_file = write_set(tmpdir, features, captions)
+    batches, _ = dataIterator(feature_file, label_file, dictionary(), 6, 30000, 100, 30000)
+    # an undersized pool grows on demand; every slot is reused with stale content from a larger batch
+    buffers = BatchBuffers(1, 1, 1, pool_size=2)
+    for batch_x, batch_y in batches + batches[::-1]:
+        for got, expected in zip(buffers.prepare(batch_x, batch_y), baseline_prepare_data(batch_x, batch_y)):
+            assert got.shape == expected.shape
+            assert got.dtype == expected.dtype
+            # pixels are scaled by float32(1/255) instead of divided in float64: equal up to the last bit
+            numpy.testing.assert_allclose(got, expected, rtol=1e-6, atol=0)
+        for got, expected in zip(prepare_data(batch_x, batch_y), baseline_prepare_data(batch_x, batch_y)):
+            numpy.testing.assert_allclose(got, expected, rtol=1e-6, atol=0)
+
+def test_batch_buffers_keep_pool_size_batches_alive():
+    rng = numpy.random.RandomState(3)
+    batches = [([rng.randint(0, 256, (1, 10, 20)).astype('uint8')], [[1, 2]]) for _ in range(3)]
+    buffers = BatchBuffers.from_batches(batches, pool_size=2)
+    first = buffers.prepare(*batches[0])[0].copy()
+    kept = buffers.prepare(*batches[0])[0]
+    buffers.prepare(*batches[1])
+    numpy.testing.assert_array_equal(kept, first)
+
+
+def test_bucket_sampler_respects_the_batch_budget():
+    features, captions = synthetic_set(n=200, seed=7)
+    uids = sorted(features)
+    sampler = BucketSampler([features[u] for u in uids], [captions[u] for u in uids], batch_size=8,
+        batch_Imagesize=20000, rng=numpy.random.RandomState(0))
+    for _ in range(3):
+        seen = 0
+        padded = 0
+        for images_x, seqs_y in sampler:
+            n = len(images_x)
+            size = n * max(s.shape[1] for s in images_x) * max(s.shape[2] for s in images_x)
+            assert 1 <= n <= 8
+            # a single image above the budget still gets its own batch
+            assert n == 1 or size <= 20000
+            seen += n
+            padded += size
+        assert seen == len(uids)
+        real = sum(f.shape[1] * f.shape[2] for f in features.values())
+        assert abs(sampler.padding_ratio - (1. - float(real) / padded)) < 1e-9
+
+def test_bucket_sampler_restore_repeats_a_pass():
+    features, captions = synthetic_set(n=60, seed=8)
+    uids = sorted(features)
+    sampler = BucketSampler([features[u] for u in uids], [captions[u] for u in uids], 4, 20000,
+        rng=numpy.random.RandomState(1))
+    state = sampler.build_state
+    first = [[id(s) for s in images_x] for images_x, _ in sampler]
+    list(sampler)
+    sampler.restore(state)
+    assert [[id(s) for s in images_x] for images_x, _ in sampler] == first
+
+
+def test_crop_ink_keeps_the_ink_and_a_margin():
+    fea = numpy.zeros((1, 50, 80), dtype='uint8')
+    fea[0, 10:20, 30:45] = 200
+    cropped = crop_ink(fea, margin=2)
+    assert cropped.shape == (1, 14, 19)
+    assert cropped.sum() == fea.sum()
+    # ink at the border: the margin is clipped to the image
+    fea[0, 0, 0] = 255
+    assert crop_ink(fea, margin=2).shape == (1, 22, 47)
+    blank = numpy.zeros((1, 7, 9), dtype='uint8')
+    assert crop_ink(blank) is blank
+
+def test_downscale_is_an_area_average():
+    rng = numpy.random.RandomState(2)
+    fea = rng.randint(0, 256, (1, 60, 200)).astype('uint8')
+    small = downscale(fea, 30 * 100)
+    assert small.shape == (1, 30, 100)
+    assert small.dtype == numpy.uint8
+    # integer factor 2: every output pixel is the rounded mean of a 2x2 block
+    blocks = fea[0].reshape(30, 2, 100, 2).astype('float64').mean(axis=(1, 3))
+    assert numpy.abs(small[0].astype('int64') - numpy.round(blocks)).max() <= 1
+    # within budget: untouched
+    assert downscale(fea, fea.shape[1] * fea.shape[2]) is fea
+
+def test_downscale_keeps_the_aspect_ratio_under_the_budget():
+    fea = numpy.full((1, 213, 1517), 255, dtype='uint8')
+    small = downscale(fea, 100000)
+    assert small.shape[1] * small.shape[2] <= 100000
+    assert abs(float(small.shape[2]) / small.shape[1] - 1517. / 213) < 0.05
+    assert (small == 255).all()
+
+def test_shard_inputs_are_not_preprocessed_again(tmpdir):
+    features, captions = synthetic_set()
+    feature_file, label_file = write_set(tmpdir, features, captions)
+    shard_dir = os.path.join(str(tmpdir), 'shards')
+    compile_shards(feature_file, label_file, dictionary(), shard_dir, max_pixels=1000, crop=True)
+    batches, _ = dataIterator(shard_dir, None, dictionary(), 4, 20000, 100, 20000, crop=True, max_pixels=1000)
+    for images_x, _ in batches:
+        for fea in images_x:
+            assert isinstance(fea.base, numpy.memmap)
+            assert fea.shape[1] * fea.shape[2] <= 1000
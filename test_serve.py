@@ -0,0 +1,110 @@
+import io
+import time
+import threading
+import pytest
+import numpy as np
+
+pytest.importorskip('tensorflow')
+from serve import DynamicBatcher, read_image
+
+# DynamicBatcher with a stand-in recognizer; no TF graph is built.
+
+class FakeRecognizer():
+    def __init__(self, hold=None, fail=False):
+        self.batches = []
+        self.hold = hold            # event the first decode waits for, so requests queue up behind it
+        self.fail = fail
+
+    def decode(self, images):
+        if self.hold is not None:
+            self.hold.wait()
+            self.hold = None
+        self.batches.append([int(img[0, 0, 0]) for img in images])
+        if self.fail:
+            raise RuntimeError('decode failed')
+        return [['tok%d' % int(img[0, 0, 0])] for img in images]
+
+def image(tag, h=10, w=10):
+    img = np.zeros((1, h, w), dtype='uint8')
+    img[0, 0, 0] = tag
+    return img
+
+def submit_all(batcher, images, stagger=0.):
+    results = [None] * len(images)
+    def run(idx):
+        results[idx] = batcher.submit(images[idx])
+    threads = []
+    for idx in range(len(images)):
+        thread = threading.Thread(target=run, args=(idx,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(stagger)
+    for thread in threads:
+        thread.join(10.)
+    return results
+
+
+def test_every_request_gets_its_own_result():
+    recognizer = FakeRecognizer()
+    batcher = DynamicBatcher(recognizer, max_batch=4, max_latency=0.05, max_pixels=10**6)
+    images = [image(tag) for tag in range(1, 11)]
+    assert submit_all(batcher, images) == [['tok%d' % tag] for tag in range(1, 11)]
+    assert all(len(batch) <= 4 for batch in recognizer.batches)
+    assert sorted(tag for batch in recognizer.batches for tag in batch) == list(range(1, 11))
+    metrics = batcher.metrics()
+    assert metrics['requests'] == 10
+    assert metrics['batches'] == len(recognizer.batches)
+    assert metrics['queue_depth'] == 0
+    assert metrics['latency_p50_ms'] <= metrics['latency_p99_ms']
+
+def test_batches_stay_within_the_pixel_budget():
+    recognizer = FakeRecognizer()
+    batcher = DynamicBatcher(recognizer, max_batch=8, max_latency=0.05, max_pixels=1000)
+    sizes = [(10, 10), (20, 40), (10, 10), (10, 30), (25, 30), (10, 10)]
+    images = [image(tag + 1, h, w) for tag, (h, w) in enumerate(sizes)]
+    submit_all(batcher, images)
+    for batch in recognizer.batches:
+        hs = [sizes[tag - 1][0] for tag in batch]
+        ws = [sizes[tag - 1][1] for tag in batch]
+        assert len(batch) == 1 or len(batch) * max(hs) * max(ws) <= 1000
+
+def test_a_request_over_the_budget_is_not_overtaken():
+    hold = threading.Event()
+    recognizer = FakeRecognizer(hold=hold)
+    batcher = DynamicBatcher(recognizer, max_batch=8, max_latency=1., max_pixels=1000)
+    first = threading.Thread(target=batcher.submit, args=(image(100),))
+    first.start()
+    time.sleep(0.1)                 # the first request is being decoded, the next ones queue up
+    threading.Timer(0.3, hold.set).start()
+    # 2 (20x40) fits in no batch with another image and must still be decoded before 3 and 4
+    submit_all(batcher, [image(1), image(2, 20, 40), image(3), image(4)], stagger=0.02)
+    first.join(10.)
+    order = [tag for batch in recognizer.batches for tag in batch]
+    assert order == [100, 1, 2, 3, 4]
+
+def test_decode_errors_reach_the_caller():
+    batcher = DynamicBatcher(FakeRecognizer(fail=True), max_batch=2, max_latency=0.01)
+    with pytest.raises(RuntimeError):
+        batcher.submit(image(1))
+
+
+def test_read_image_takes_npy_arrays_as_is():
+    fp = io.BytesIO()
+    arr = np.arange(12, dtype='uint8').reshape(3, 4)
+    np.save(fp, arr)
+    got = read_image(fp.getvalue(), 'application/octet-stream')
+    assert got.shape == (1, 3, 4)
+    np.testing.assert_array_equal(got[0], arr)
+    with pytest.raises(ValueError):
+        fp = io.BytesIO()
+        np.save(fp, np.zeros((2, 3, 4), dtype='uint8'))
+        read_image(fp.getvalue(), 'application/octet-stream')
+
+def test_read_image_inverts_png_uploads():
+    Image = pytest.importorskip('PIL.Image')
+    page = np.full((6, 8), 255, dtype='uint8')
+    page[2:4, 3:6] = 0                              # black ink on a white page
+    fp = io.BytesIO()
+    Image.fromarray(page).save(fp, format='PNG')
+    got = read_image(fp.getvalue(), 'image/png')
+    np.testing.assert_array_equal(got[0], 255 - page)
@@ -0,0 +1,73 @@
+import numpy
+from wer import cmp_result, edit_distance_batch, process, StreamingScorer
+
+# The batched scorer against the per-cell DP of the original compute-wer.py.
+
+def reference_cmp_result(label, rec):
+    dist_mat = numpy.zeros((len(label)+1, len(rec)+1), dtype='int32')
+    dist_mat[0,:] = range(len(rec) + 1)
+    dist_mat[:,0] = range(len(label) + 1)
+    for i in range(1, len(label) + 1):
+        for j in range(1, len(rec) + 1):
+            hit_score = dist_mat[i-1, j-1] + (label[i-1] != rec[j-1])
+            ins_score = dist_mat[i,j-1] + 1
+            del_score = dist_mat[i-1, j] + 1
+            dist_mat[i,j] = min(hit_score, ins_score, del_score)
+    return int(dist_mat[len(label), len(rec)]), len(label)
+
+def random_pairs(n, seed=1234):
+    rng = numpy.random.RandomState(seed)
+    pairs = []
+    for _ in range(n):
+        label = list(rng.randint(0, 6, rng.randint(0, 12)))
+        rec = list(rng.randint(0, 6, rng.randint(0, 12)))
+        pairs.append((label, rec))
+    return pairs
+
+def test_cmp_result_matches_reference():
+    for label, rec in random_pairs(200) + [([], []), (['a'], []), ([], ['a'])]:
+        assert cmp_result(label, rec) == reference_cmp_result(label, rec)
+
+def test_all_empty_chunks():
+    for labels, recs in [([[1, 2], [3]], [[], []]), ([[], []], [[1], [2, 3]]), ([[], []], [[], []])]:
+        dist, sub, ins, dele, label_len = edit_distance_batch(labels, recs)
+        expected = [reference_cmp_result(l, r)[0] for l, r in zip(labels, recs)]
+        assert list(dist) == expected
+        assert list(sub + ins + dele) == expected
+
+def test_batch_split_matches_distance():
+    pairs = random_pairs(300, seed=5)
+    dist, sub, ins, dele, label_len = edit_distance_batch([l for l, r in pairs], [r for l, r in pairs], chunk=16)
+    assert list(dist) == [reference_cmp_result(l, r)[0] for l, r in pairs]
+    assert list(sub + ins + dele) == list(dist)
+    assert list(label_len) == [len(l) for l, r in pairs]
+
+def test_streaming_scorer_empty_hypotheses():
+    labels = dict(('u%d' % k, [1, 2, k]) for k in range(10))
+    scorer = StreamingScorer(labels)
+    for uid in sorted(labels):
+        scorer.push(uid, [])
+    assert scorer.wer == 1.
+    assert scorer.exprate == 0.
+
+def test_streaming_scorer_matches_process(tmpdir):
+    pairs = random_pairs(120, seed=9)
+    labels = dict(('u%03d' % k, [str(t) for t in l]) for k, (l, r) in enumerate(pairs))
+    recs = dict(('u%03d' % k, [str(t) for t in r]) for k, (l, r) in enumerate(pairs))
+    recfile = str(tmpdir.join('rec.txt'))
+    labelfile = str(tmpdir.join('label.txt'))
+    for path, mat in [(recfile, recs), (labelfile, labels)]:
+        with open(path, 'w') as fp:
+            for uid in sorted(mat):
+                fp.write(' '.join([uid] + mat[uid]) + '\n')
+    wer, sacc = process(recfile, labelfile, str(tmpdir.join('process.wer')))
+
+    scorer = StreamingScorer(labels)
+    for k, uid in enumerate(sorted(recs)):
+        scorer.push(uid, recs[uid])
+        if k % 10 == 9:
+            scorer.wer             # reads in between, as the validation loop does
+    scorer.write(str(tmpdir.join('stream.wer')))
+    assert abs(scorer.wer - wer) < 1e-12
+    assert abs(scorer.exprate - sacc) < 1e-12
+    assert tmpdir.join('stream.wer').read() == tmpdir.join('process.wer').read()
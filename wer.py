@@ -0,0 +1,177 @@
+import numpy
+
+# Token edit distance for WER / ExpRate scoring. Pairs are scored in batches: each
+# DP row is computed for every pair at once, with the insertion chain along the row
+# resolved by a running minimum (D[i, j] = min_k(T[k] + j - k)), so there are no
+# per-cell Python loops. A vectorized backtrace splits the distance into
+# substitutions, insertions and deletions.
+
+def edit_distance_batch(labels, recs, chunk=256):
+    #### returns dist, sub, ins, dele, label_len as int arrays aligned with the input pairs ####
+    n_pairs = len(labels)
+    dist = numpy.zeros(n_pairs, dtype='int64')
+    sub = numpy.zeros(n_pairs, dtype='int64')
+    ins = numpy.zeros(n_pairs, dtype='int64')
+    dele = numpy.zeros(n_pairs, dtype='int64')
+    label_len = numpy.array([len(l) for l in labels], dtype='int64')
+    if n_pairs == 0:
+        return dist, sub, ins, dele, label_len
+
+    # shared token ids so that comparisons are integer compares
+    vocab = {}
+    def encode(seq):
+        return [vocab.setdefault(tok, len(vocab)) for tok in seq]
+    labels = [encode(l) for l in labels]
+    recs = [encode(r) for r in recs]
+
+    # similar lengths in one chunk keep the padded DP tables small
+    order = numpy.argsort([len(l) + len(r) for l, r in zip(labels, recs)], kind='stable')
+    for start in range(0, n_pairs, chunk):
+        idx = order[start:start + chunk]
+        d, s, i, e = _edit_distance_chunk([labels[k] for k in idx], [recs[k] for k in idx])
+        dist[idx] = d
+        sub[idx] = s
+        ins[idx] = i
+        dele[idx] = e
+    return dist, sub, ins, dele, label_len
+
+def _edit_distance_chunk(labels, recs):
+    n = len(labels)
+    len_l = numpy.array([len(l) for l in labels], dtype='int64')
+    len_r = numpy.array([len(r) for r in recs], dtype='int64')
+    max_l = int(len_l.max())
+    max_r = int(len_r.max())
+
+    # at least one column, so the backtrace lookups stay in range when every
+    # label (or every hypothesis) of the chunk is empty
+    lab = numpy.full((n, max(max_l, 1)), -1, dtype='int64')
+    rec = numpy.full((n, max(max_r, 1)), -2, dtype='int64')
+    for b in range(n):
+        lab[b, :len_l[b]] = labels[b]
+        rec[b, :len_r[b]] = recs[b]
+
+    cols = numpy.arange(max_r + 1, dtype='int32')
+    dist_mat = numpy.empty((n, max_l + 1, max_r + 1), dtype='int32')
+    dist_mat[:, 0, :] = cols
+    for i in range(1, max_l + 1):
+        prev = dist_mat[:, i - 1, :]
+        neq = lab[:, i - 1:i] != rec[:, :max_r]                        # [n, max_r]
+        row = numpy.empty((n, max_r + 1), dtype='int32')
+        row[:, 0] = i
+        row[:, 1:] = numpy.minimum(prev[:, :-1] + neq, prev[:, 1:] + 1) # substitution / hit, deletion
+        dist_mat[:, i, :] = numpy.minimum.accumulate(row - cols, axis=1) + cols  # insertions
+
+    rows = numpy.arange(n)
+    dist = dist_mat[rows, len_l, len_r].astype('int64')
+
+    #### backtrace of all pairs in lock-step ####
+    sub = numpy.zeros(n, dtype='int64')
+    ins = numpy.zeros(n, dtype='int64')
+    dele = numpy.zeros(n, dtype='int64')
+    i = len_l.copy()
+    j = len_r.copy()
+    active = (i > 0) | (j > 0)
+    while active.any():
+        b = rows[active]
+        ib = i[b]
+        jb = j[b]
+        cur = dist_mat[b, ib, jb]
+        can_diag = (ib > 0) & (jb > 0)
+        mismatch = lab[b, numpy.maximum(ib - 1, 0)] != rec[b, numpy.maximum(jb - 1, 0)]
+        diag = can_diag & (dist_mat[b, numpy.maximum(ib - 1, 0), numpy.maximum(jb - 1, 0)] + mismatch == cur)
+        left = ~diag & (jb > 0) & (dist_mat[b, ib, numpy.maximum(jb - 1, 0)] + 1 == cur)
+        up = ~diag & ~left
+        sub[b] += diag & mismatch
+        ins[b] += left
+        dele[b] += up
+        i[b] = ib - (diag | up)
+        j[b] = jb - (diag | left)
+        active = (i > 0) | (j > 0)
+
+    return dist, sub, ins, dele
+
+def cmp_result(label,rec):
+    dist, _, _, _, label_len = edit_distance_batch([label], [rec])
+    return int(dist[0]), int(label_len[0])
+
+def read_result(filename):
+    mat = {}
+    with open(filename) as f:
+        for line in f:
+            tmp = line.split()
+            if not tmp:
+                continue
+            mat[tmp[0]] = tmp[1:]
+    return mat
+
+def process(recfile, labelfile, resultfile):
+    rec_mat = read_result(recfile)
+    label_mat = read_result(labelfile)
+    keys = list(rec_mat.keys())
+    dist, sub, ins, dele, label_len = edit_distance_batch([label_mat[k] for k in keys], [rec_mat[k] for k in keys])
+
+    total_label = max(label_len.sum(), 1)
+    wer = float(dist.sum())/total_label
+    sacc = float((dist == 0).sum())/max(len(keys), 1)
+
+    f_result = open(resultfile,'w')
+    f_result.write('WER {}\n'.format(wer))
+    f_result.write('ExpRate {}\n'.format(sacc))
+    f_result.write('Sub {} Ins {} Del {}\n'.format(float(sub.sum())/total_label,
+        float(ins.sum())/total_label, float(dele.sum())/total_label))
+    f_result.close()
+    return wer, sacc
+
+
+class StreamingScorer():
+    # Running WER / ExpRate totals that decoders push (uid, tokens) into as they
+    # finish. Pushed pairs are scored together on the next read of the totals
+    # (the training loop reads them every 10 samples), so the totals are exact at
+    # any moment.
+    def __init__(self, labels):
+        self.labels = labels            # uid -> reference tokens
+        self.pending = []
+        self.total_dist = 0
+        self.total_label = 0
+        self.total_line = 0
+        self.total_line_rec = 0
+        self.total_sub = 0
+        self.total_ins = 0
+        self.total_del = 0
+
+    def push(self, uid, tokens):
+        self.pending.append((self.labels[uid], list(tokens)))
+
+    def flush(self):
+        if not self.pending:
+            return
+        dist, sub, ins, dele, label_len = edit_distance_batch([l for l, r in self.pending], [r for l, r in self.pending])
+        self.pending = []
+        self.total_dist += int(dist.sum())
+        self.total_label += int(label_len.sum())
+        self.total_line += len(dist)
+        self.total_line_rec += int((dist == 0).sum())
+        self.total_sub += int(sub.sum())
+        self.total_ins += int(ins.sum())
+        self.total_del += int(dele.sum())
+
+    @property
+    def wer(self):
+        self.flush()
+        return float(self.total_dist)/max(self.total_label, 1)
+
+    @property
+    def exprate(self):
+        self.flush()
+        return float(self.total_line_rec)/max(self.total_line, 1)
+
+    def write(self, resultfile):
+        #### same layout as process() ####
+        self.flush()
+        total_label = max(self.total_label, 1)
+        f_result = open(resultfile,'w')
+        f_result.write('WER {}\n'.format(self.wer))
+        f_result.write('ExpRate {}\n'.format(self.exprate))
+        f_result.write('Sub {} Ins {} Del {}\n'.format(float(self.total_sub)/total_label,
+            float(self.total_ins)/total_label, float(self.total_del)/total_label))
+        f_result.close()